@@ -0,0 +1,352 @@
+#Non-interactive benchmark of MTree against a linear scan.
+#
+#For every dataset, max_node_size and promote/partition policy it measures
+#the build (time, distance calls, peak memory with tracemalloc) and the k-NN
+#and range queries (p50/p99 latency, distance evaluations per query, results
+#checked against a brute-force scan), and writes everything as JSON:
+#
+#   python benchmark.py --datasets pandas uniform --node-sizes 8 16 32 \
+#       --output bench.json
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import mtree
+
+DATASETS = ('pandas', 'uniform', 'clustered', 'duplicates')
+
+SYNTHETIC_SIZE = 5000
+
+PROMOTE = collections.OrderedDict([
+    ('M_LB_DIST_confirmed', mtree.M_LB_DIST_confirmed),
+    ('M_LB_DIST_non_confirmed', mtree.M_LB_DIST_non_confirmed),
+    ('mM_RAD', mtree.mM_RAD),
+    ('mM_RAD_sampled', mtree.mM_RAD_sampled),
+    ('RANDOM', mtree.RANDOM),
+    ('SAMPLING', mtree.SAMPLING)])
+
+PARTITION = collections.OrderedDict([
+    ('generalized_hyperplane', mtree.generalized_hyperplane),
+    ('balanced_partition', mtree.balanced_partition)])
+
+METRICS = {'l1': mtree.L1, 'l2': mtree.L2}
+
+
+def load_pandas(args, rng):
+    import main
+    _, features = main.load_dataset(args.csv)
+    return features[:args.size] if args.size else features
+
+
+#rows of the generated datasets: --size, 5000 by default
+def synthetic_size(args):
+    return SYNTHETIC_SIZE if args.size is None else args.size
+
+
+#uniform vectors in [0, 1)^dim
+def make_uniform(args, rng):
+    return rng.random_sample((synthetic_size(args), args.dim))
+
+
+#gaussian blobs around args.clusters random centers
+def make_clustered(args, rng):
+    centers = rng.random_sample((args.clusters, args.dim))
+    labels = rng.randint(args.clusters, size=synthetic_size(args))
+    return centers[labels] + rng.normal(0, 0.02, (len(labels), args.dim))
+
+
+#args.distinct vectors repeated to args.size rows, like the many identical
+#patients of Pandas.csv
+def make_duplicates(args, rng):
+    distinct = rng.random_sample((args.distinct, args.dim)).round(1)
+    return distinct[rng.randint(args.distinct, size=synthetic_size(args))]
+
+
+LOADERS = {'pandas': load_pandas, 'uniform': make_uniform,
+           'clustered': make_clustered, 'duplicates': make_duplicates}
+
+
+def _python_l1(a, b):
+    return sum(abs(x - y) for x, y in zip(a, b))
+
+
+def _python_l2(a, b):
+    return sum((x - y) ** 2 for x, y in zip(a, b)) ** 0.5
+
+
+PYTHON_METRICS = {'l1': _python_l1, 'l2': _python_l2}
+
+
+#the metric and the objects for the mode: rows of the matrix with a
+#vectorized metric, or tuples with a plain python function
+def prepare(data, args):
+    if args.mode == 'vector':
+        return METRICS[args.metric](), data
+    return PYTHON_METRICS[args.metric], [tuple(float(x) for x in row)
+                                         for row in data]
+
+
+#queries near the data: random rows plus a little noise
+def make_queries(data, args, rng):
+    rows = data[rng.randint(len(data), size=args.queries)]
+    noise = rng.normal(0, 0.01, rows.shape) * (data.std(axis=0) + 1e-12)
+    queries = rows + noise
+    if args.mode == 'python':
+        return [tuple(float(x) for x in q) for q in queries]
+    return list(queries)
+
+
+def percentiles(values):
+    values = np.asarray(values, 'float64')
+    return collections.OrderedDict([
+        ('mean', float(values.mean())),
+        ('p50', float(np.percentile(values, 50))),
+        ('p99', float(np.percentile(values, 99)))])
+
+
+#the linear scan the tree is compared with: all the distances of a query,
+#in one call in vector mode
+class BruteForce(object):
+    def __init__(self, d, objects, data):
+        self.d = d
+        self.objects = objects
+        self.data = data
+
+    def distances(self, query):
+        if hasattr(self.d, 'batch'):
+            return self.d.batch(self.data, np.asarray(query))
+        return np.array([self.d(obj, query) for obj in self.objects])
+
+    def knn(self, query, k):
+        return np.sort(self.distances(query))[:k]
+
+    def range(self, query, radius):
+        distances = self.distances(query)
+        return np.sort(distances[distances <= radius])
+
+
+def time_queries(run, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        run(query)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def build(d, objects, node_size, promote, partition, bulk_load, seed,
+          collapse_duplicates=False):
+    tree = mtree.MTree(d, node_size, promote, partition, seed,
+                       collapse_duplicates)
+    stats = tree.add_all(objects, bulk_load=bulk_load)
+    return tree, stats
+
+
+def peak_build_memory(d, objects, node_size, promote, partition, bulk_load,
+                      seed, collapse_duplicates=False):
+    tracemalloc.start()
+    try:
+        build(d, objects, node_size, promote, partition, bulk_load, seed,
+              collapse_duplicates)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_tree(d, objects, data, queries, radius, brute, node_size,
+                   promote, partition, args):
+    tree, build_stats = build(d, objects, node_size, PROMOTE[promote],
+                              PARTITION[partition], args.build == 'bulk',
+                              args.seed, args.collapse_duplicates)
+    optimize_stats = tree.optimize() if args.optimize else None
+    if args.pivots:
+        tree.select_pivots(args.pivots, rng=random.Random(args.seed))
+    result = collections.OrderedDict([
+        ('node_size', node_size),
+        ('promote', promote),
+        ('partition', partition),
+        ('build', collections.OrderedDict([
+            ('method', args.build),
+            ('seconds', build_stats.seconds),
+            ('distance_calls', build_stats.distance_calls),
+            ('peak_memory_bytes', None if args.no_memory else
+             peak_build_memory(d, objects, node_size, PROMOTE[promote],
+                               PARTITION[partition], args.build == 'bulk',
+                               args.seed, args.collapse_duplicates)),
+            ('footprint_bytes', tree.memory_footprint()['total']),
+            ('optimize', optimize_stats and
+             collections.OrderedDict(optimize_stats._asdict()))]))])
+
+    for kind, run, expected in [
+            ('knn', lambda q: tree.search(q, args.k),
+             lambda q: brute.knn(q, args.k)),
+            ('range', lambda q: tree.search_in_radius(q, radius),
+             lambda q: brute.range(q, radius))]:
+        latencies = time_queries(run, queries)
+        stats = tree.enable_stats()
+        correct = 0
+        for query in queries:
+            found = np.sort([float(tree.d(obj, query)) for obj in run(query)])
+            want = expected(query)
+            correct += len(found) == len(want) and \
+                np.allclose(found, want, rtol=1e-6, atol=1e-9)
+        tree.disable_stats()
+        result[kind] = collections.OrderedDict([
+            ('latency_seconds', percentiles(latencies)),
+            ('distance_calls', percentiles([record.distance_calls
+                                            for record in stats.queries])),
+            ('nodes_visited', percentiles([record.nodes_visited
+                                           for record in stats.queries])),
+            ('correct', correct / float(len(queries)))])
+
+    if args.flat:
+        flat = tree.freeze()
+        result['flat'] = collections.OrderedDict([
+            ('footprint_bytes', flat.memory_footprint()['total']),
+            ('knn_latency_seconds', percentiles(time_queries(
+                lambda q: flat.search(q, args.k), queries))),
+            ('range_latency_seconds', percentiles(time_queries(
+                lambda q: flat.search_in_radius(q, radius), queries)))])
+    return result
+
+
+def benchmark_dataset(name, args):
+    rng = np.random.RandomState(args.seed)
+    random.seed(args.seed)
+    data = np.ascontiguousarray(LOADERS[name](args, rng), 'float64')
+    d, objects = prepare(data, args)
+    queries = make_queries(data, args, rng)
+    brute = BruteForce(d, objects, data)
+    radius = args.radius
+    if radius is None:
+        #median distance to the k-th nearest neighbour
+        radius = float(np.median([brute.knn(q, args.k)[-1]
+                                  for q in queries]))
+
+    result = collections.OrderedDict([
+        ('dataset', name),
+        ('size', len(data)),
+        ('dim', data.shape[1]),
+        ('radius', radius),
+        ('brute_force', collections.OrderedDict([
+            ('knn_latency_seconds', percentiles(time_queries(
+                lambda q: brute.knn(q, args.k), queries))),
+            ('range_latency_seconds', percentiles(time_queries(
+                lambda q: brute.range(q, radius), queries))),
+            ('distance_calls', len(data))])),
+        ('trees', [])])
+    for node_size in args.node_sizes:
+        for promote in args.promote:
+            for partition in args.partition:
+                run = benchmark_tree(d, objects, data, queries, radius, brute,
+                                     node_size, promote, partition, args)
+                result['trees'].append(run)
+                report(name, result, run)
+    return result
+
+
+def report(name, dataset, run):
+    brute = dataset['brute_force']
+    print('%-10s M=%-3d %-24s %-22s build %7.3fs %9d d()  '
+          'knn p50 %.2e s (scan %.2e) %6.0f d()  '
+          'range p50 %.2e s (scan %.2e) %6.0f d()  correct %.2f/%.2f' % (
+              name, run['node_size'], run['promote'], run['partition'],
+              run['build']['seconds'], run['build']['distance_calls'],
+              run['knn']['latency_seconds']['p50'],
+              brute['knn_latency_seconds']['p50'],
+              run['knn']['distance_calls']['mean'],
+              run['range']['latency_seconds']['p50'],
+              brute['range_latency_seconds']['p50'],
+              run['range']['distance_calls']['mean'],
+              run['knn']['correct'], run['range']['correct']))
+    sys.stdout.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark MTree builds and queries against a linear '
+                    'scan.')
+    parser.add_argument('--datasets', nargs='+', choices=DATASETS,
+                        default=list(DATASETS))
+    parser.add_argument('--csv', default='Pandas.csv',
+                        help='path of the pandas dataset')
+    parser.add_argument('--size', type=int, default=None,
+                        help='number of objects (default: all the rows of '
+                             'the pandas dataset, %d for the generated '
+                             'ones)' % SYNTHETIC_SIZE)
+    parser.add_argument('--dim', type=int, default=8,
+                        help='dimension of the synthetic datasets')
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--distinct', type=int, default=200,
+                        help='distinct vectors of the duplicates dataset')
+    parser.add_argument('--node-sizes', type=int, nargs='+',
+                        default=[8, 16, 32])
+    parser.add_argument('--promote', nargs='+', choices=list(PROMOTE),
+                        default=['M_LB_DIST_confirmed'])
+    parser.add_argument('--partition', nargs='+', choices=list(PARTITION),
+                        default=['generalized_hyperplane'])
+    parser.add_argument('--build', choices=('bulk', 'incremental'),
+                        default='bulk',
+                        help='bulk-loading does not use the promote and '
+                             'partition policies, compare them with '
+                             'incremental builds')
+    parser.add_argument('--mode', choices=('vector', 'python'),
+                        default='vector',
+                        help='numpy rows with a vectorized metric or tuples '
+                             'with a python distance function')
+    parser.add_argument('--metric', choices=sorted(METRICS), default='l1')
+    parser.add_argument('--pivots', type=int, default=0,
+                        help='number of pivots of the LAESA filtering')
+    parser.add_argument('--collapse-duplicates', action='store_true',
+                        help='store equal objects in a single entry')
+    parser.add_argument('--optimize', action='store_true',
+                        help='run the slim-down (MTree.optimize) after the '
+                             'build')
+    parser.add_argument('--flat', action='store_true',
+                        help='also time the queries on the tree frozen in a '
+                             'flat arena (FlatMTree)')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--radius', type=float, default=None,
+                        help='range query radius (default: median distance '
+                             'to the k-th nearest neighbour)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc build (a second build)')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args(argv)
+    if args.build == 'bulk' and (
+            args.promote != parser.get_default('promote') or
+            args.partition != parser.get_default('partition')):
+        #every policy would report the same bulk-loaded tree
+        parser.error('--promote and --partition need --build incremental')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = collections.OrderedDict([
+        ('mtree_version', mtree.__version__),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('platform', platform.platform()),
+        ('cpu_count', os.cpu_count()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('arguments', vars(args)),
+        ('datasets', [benchmark_dataset(name, args)
+                      for name in args.datasets])])
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#k-NN classification over an MTree.
+#
+#Predicts a column of the feature matrix of main.load_dataset (by default
+#column 0, the SARS-Cov-2 exam result) by a majority vote of the k nearest
+#patients, the distance being computed on the other columns only: the label
+#and any excluded attribute are left out of the metric instead of leaking
+#the answer into it.
+#
+#The evaluation (leave-one-out, or k-fold) queries the tree once per
+#patient, a neighbour being valid when it is not in the same group as the
+#query (itself for leave-one-out, its fold for k-fold), so a single tree
+#serves all the folds. The queries are taken in the order of the leaves,
+#which keeps near patients together, and are run by batches: a batch
+#traverses the frozen tree (FlatMTree) once, each node computing the
+#distances of all the queries of the batch still interested in it with a
+#few vectorized calls, and a query leaves a subtree as soon as the subtree
+#is farther than its k-th neighbour so far. The batches are spread over a
+#pool of processes.
+#
+#   python classifier.py --k 5                 #leave-one-out
+#   python classifier.py --k 5 --folds 10 --processes 4 --exclude 1
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import mtree
+
+
+class KNNClassifier(object):
+    #features is the matrix of the patients, labels the values to predict
+    #(one per row). The columns of exclude are not part of the metric
+    #(mtree.L1() by default, any metric with a batch method)
+    def __init__(self, features, labels, k=5, metric=None, exclude=(),
+                 max_node_size=32, seed=0):
+        metric = mtree.L1() if metric is None else metric
+        if not callable(getattr(metric, 'batch', None)):
+            raise TypeError('metric must be vectorized (have a batch method)')
+        features = np.asarray(features)
+        if len(features) != len(labels):
+            raise ValueError('%d rows but %d labels' % (len(features),
+                                                        len(labels)))
+        self.k = k
+        self.exclude = sorted(set(exclude))
+        self.columns = [c for c in range(features.shape[1])
+                        if c not in self.exclude]
+        self.data = np.ascontiguousarray(features[:, self.columns],
+                                         metric.dtype)
+        self.classes, self.codes = np.unique(np.asarray(labels),
+                                             return_inverse=True)
+        self.tree = mtree.MTree(metric, max_node_size, seed=seed)
+        self.build = self.tree.add_all(self.data)
+        self.flat = self.tree.freeze()
+        rows = np.array([obj.index for obj in self.flat.objects], 'int64')
+        entry_object = np.frombuffer(self.flat.entry_object, 'int64')
+        entry_child = np.frombuffer(self.flat.entry_child, 'int64')
+        #the row of the object of each entry of the flat tree
+        self.entry_row = rows[entry_object]
+        #the rows in the order of the leaves: near rows are near in it
+        self.leaf_order = self.entry_row[entry_child < 0]
+
+    def __len__(self):
+        return len(self.data)
+
+    #the predicted labels of the rows of features (all the columns, as given
+    #to the constructor)
+    def predict(self, features, batch_size=256):
+        queries = np.ascontiguousarray(np.asarray(features)[:, self.columns],
+                                       self.data.dtype)
+        predictions = np.empty(len(queries), 'int64')
+        for start in range(0, len(queries), batch_size):
+            batch = slice(start, start + batch_size)
+            predictions[batch] = self._vote(
+                _batch_knn(self.flat, self.entry_row, queries[batch],
+                           self.k)[0])
+        return self.classes[predictions]
+
+    #Leave-one-out (folds None) or k-fold evaluation, the folds drawn at
+    #random with seed. batched False runs one MTree.nearest per query
+    #instead, for comparison. Returns an OrderedDict with the accuracy, the
+    #confusion matrix (counts per true label and predicted label) and the
+    #throughput
+    def evaluate(self, folds=None, processes=None, batch_size=256,
+                 batched=True, seed=0):
+        global _worker_state
+        n = len(self.data)
+        if folds is None:
+            groups = np.arange(n)
+        else:
+            groups = np.random.RandomState(seed).permutation(n) % folds
+        if processes is None:
+            processes = os.cpu_count() or 1
+        #chunks of consecutive batches in leaf order, a few per process
+        chunk_size = batch_size * max(1, -(-n // (batch_size * processes *
+                                                  4)))
+        chunks = [self.leaf_order[start:start + chunk_size]
+                  for start in range(0, n, chunk_size)]
+        task = (groups, batch_size, batched)
+
+        start = time.perf_counter()
+        if processes <= 1 or len(chunks) <= 1:
+            results = [_evaluate_chunk(self, task, rows) for rows in chunks]
+        else:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+                initializer, initargs = None, ()
+                _worker_state = (self, task)
+            else:
+                context = multiprocessing.get_context()
+                initializer, initargs = _init_worker, (self, task)
+            try:
+                with context.Pool(min(processes, len(chunks)), initializer,
+                                  initargs) as pool:
+                    results = pool.map(_worker_chunk, chunks)
+            finally:
+                _worker_state = None
+        seconds = time.perf_counter() - start
+
+        predictions = np.empty(n, 'int64')
+        distance_calls = 0
+        for rows, (predicted, calls) in zip(chunks, results):
+            predictions[rows] = predicted
+            distance_calls += calls
+        confusion = np.zeros((len(self.classes), len(self.classes)), 'int64')
+        np.add.at(confusion, (self.codes, predictions), 1)
+        correct = int(np.trace(confusion))
+        return collections.OrderedDict([
+            ('evaluation', 'leave-one-out' if folds is None
+             else '%d-fold' % folds),
+            ('k', self.k),
+            ('excluded_columns', self.exclude),
+            ('queries', n),
+            ('correct', correct),
+            ('accuracy', correct / float(n)),
+            ('confusion', collections.OrderedDict(
+                (str(label), collections.OrderedDict(
+                    (str(predicted), int(count))
+                    for predicted, count in zip(self.classes, counts)))
+                for label, counts in zip(self.classes, confusion))),
+            ('batched', batched),
+            ('batch_size', batch_size if batched else 1),
+            ('processes', min(processes, len(chunks))),
+            ('seconds', seconds),
+            ('queries_per_second', n / seconds),
+            ('distance_calls_per_query', distance_calls / float(n))])
+
+    #the class codes voted by the rows of neighbours (-1 for none), a tie
+    #going to the class of the nearest of the tied neighbours
+    def _vote(self, neighbours):
+        valid = neighbours >= 0
+        codes = np.where(valid, self.codes[np.maximum(neighbours, 0)], 0)
+        votes = np.zeros((len(neighbours), len(self.classes)), 'int64')
+        np.add.at(votes, (np.nonzero(valid)[0], codes[valid]), 1)
+        winners = votes == votes.max(axis=1)[:, None]
+        tied = winners[np.arange(len(codes))[:, None], codes] & valid
+        first = tied.argmax(axis=1)
+        return codes[np.arange(len(codes)), first]
+
+
+#The k nearest rows of each query of a batch (rows of one matrix) in the
+#flat tree, nearest first and by row at equal distance: (rows, distances,
+#distances computed) with -1 and inf where there are less than k. A row of
+#the same group as the query (groups of the rows indexed by row, one group
+#per query) is not a neighbour.
+#The batch goes down the tree depth-first, the nearest children first. Each
+#node is given the queries whose k-th neighbour is not nearer than its
+#ball, their distances to its entries are computed by a batch call per
+#entry, or per query if there are less queries than entries
+def _batch_knn(flat, entry_row, queries, k, query_groups=None, groups=None):
+    d = flat.d
+    vectors = flat.entry_vectors
+    radii = np.frombuffer(flat.entry_radius, 'float64')
+    node_leaf, node_first = flat.node_leaf, flat.node_first
+    node_count, entry_child = flat.node_count, flat.entry_child
+    best = np.full((len(queries), k), np.inf)
+    neighbours = np.full((len(queries), k), -1, 'int64')
+    calls = 0
+    stack = [(0, np.arange(len(queries)), np.zeros(len(queries)))]
+    while stack:
+        node, active, dmin = stack.pop()
+        active = active[dmin - mtree._ROUNDING_SLACK <= best[active, -1]]
+        if not len(active) or not node_count[node]:
+            continue
+        first = node_first[node]
+        count = node_count[node]
+        block = vectors[first:first + count]
+        if len(active) < count:
+            distances = np.array([d.batch(block, queries[q])
+                                  for q in active])
+        else:
+            distances = np.array([d.batch(queries[active], obj)
+                                  for obj in block]).T
+        calls += distances.size
+        if node_leaf[node]:
+            rows = entry_row[first:first + count]
+            if query_groups is not None:
+                distances[query_groups[active][:, None] ==
+                          groups[rows][None, :]] = np.inf
+            merged = np.concatenate([best[active], distances], axis=1)
+            merged_rows = np.concatenate(
+                [neighbours[active],
+                 np.broadcast_to(rows, distances.shape)], axis=1)
+            #equal distances are ordered by row
+            nearest = np.lexsort((merged_rows, merged), axis=1)[:, :k]
+            best[active] = np.take_along_axis(merged, nearest, axis=1)
+            neighbours[active] = np.take_along_axis(merged_rows, nearest,
+                                                    axis=1)
+            continue
+        child_dmin = np.maximum(distances - radii[first:first + count], 0)
+        #pushed farthest first, so that the nearest child is visited first
+        for j in np.argsort(child_dmin.mean(axis=0))[::-1]:
+            reached = child_dmin[:, j] - mtree._ROUNDING_SLACK <= \
+                best[active, -1]
+            if reached.any():
+                stack.append((entry_child[first + j], active[reached],
+                              child_dmin[reached, j]))
+    neighbours[np.isinf(best)] = -1
+    return neighbours, best, calls
+
+
+#(predicted class codes, distances computed) for the rows of a chunk
+def _evaluate_chunk(classifier, task, rows):
+    groups, batch_size, batched = task
+    if not batched:
+        return _evaluate_unbatched(classifier, groups, rows)
+    predicted = np.empty(len(rows), 'int64')
+    calls = 0
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        neighbours, _, batch_calls = _batch_knn(
+            classifier.flat, classifier.entry_row, classifier.data[batch],
+            classifier.k, groups[batch], groups)
+        predicted[start:start + batch_size] = classifier._vote(neighbours)
+        calls += batch_calls
+    return predicted, calls
+
+
+#one best-first search of the tree per row, the neighbours of the group of
+#the row skipped. The neighbours at the distance of the k-th one are all
+#taken, then ordered by row as in _batch_knn
+def _evaluate_unbatched(classifier, groups, rows):
+    tree, k = classifier.tree, classifier.k
+    d = tree.d
+    tree.d = counter = mtree._CountingDistance(d)
+    neighbours = np.full((len(rows), k), -1, 'int64')
+    try:
+        for i, row in enumerate(rows):
+            found = []
+            for obj, distance in tree.nearest(classifier.data[row]):
+                if len(found) >= k and distance > found[-1][0]:
+                    break
+                if groups[obj.index] != groups[row]:
+                    found.append((distance, obj.index))
+            found = [index for _, index in sorted(found)[:k]]
+            neighbours[i, :len(found)] = found
+    finally:
+        tree.d = d
+    return classifier._vote(neighbours), counter.calls
+
+
+#(KNNClassifier, task) in the processes of evaluate
+_worker_state = None
+
+def _init_worker(classifier, task):
+    global _worker_state
+    _worker_state = (classifier, task)
+
+
+def _worker_chunk(rows):
+    classifier, task = _worker_state
+    return _evaluate_chunk(classifier, task, rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='k-NN classification of the SARS-Cov-2 exam result.')
+    parser.add_argument('--csv', default='Pandas.csv')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--label', type=int, default=0,
+                        help='column to predict, left out of the metric')
+    parser.add_argument('--exclude', type=int, nargs='*', default=[],
+                        help='other columns left out of the metric')
+    parser.add_argument('--metric', choices=('l1', 'l2'), default='l1')
+    parser.add_argument('--folds', type=int, default=None,
+                        help='k-fold evaluation (default: leave-one-out)')
+    parser.add_argument('--processes', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--unbatched', action='store_true',
+                        help='one tree search per query, for comparison')
+    parser.add_argument('--max-node-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    import main as dataset
+    _, features = dataset.load_dataset(args.csv)
+    metric = {'l1': mtree.L1, 'l2': mtree.L2}[args.metric]()
+    classifier = KNNClassifier(features, features[:, args.label], args.k,
+                               metric, [args.label] + args.exclude,
+                               args.max_node_size, args.seed)
+    report = classifier.evaluate(args.folds, args.processes, args.batch_size,
+                                 not args.unbatched, args.seed)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
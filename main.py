@@ -1,27 +1,18 @@
 from mtree import *
 import mtree
 from math import sqrt
+import json
+import os
+import time
 import pandas as pd
 import numpy as np
 
-def cast(cad):
-    temp = ""
-    for i in cad:
-        if(i == ','):
-            temp += '.'
-        else:
-            temp += i
-    return float(temp)
-    
-
 class point(object):
+    __slots__ = ('ID','a','b','c','d','e','f','g','h','i','j','k')
+
     def __init__(self,ID,a,b,c,d,e,f,g,h,i,j,k):
         self.ID = ID
-        if(a=="negative"):
-            self.a = 0
-        else:
-            self.a = 1
-
+        self.a = a
         self.b = b
         self.c = c            
         self.d = d
@@ -49,99 +40,57 @@ def distance_manhat(p1,p2):
     return result
     
 
-def node_objs(node,k):
-    if isinstance(node, mtree.InternalNode):
-        result = []
-        for n in node.entries:
-            print("     "*k,"[ radio:",n.radius,"]")
-            result.extend(node_objs(n.subtree,k+1))
-        return result
-    else:
-        for i in node.entries:
-            print("     "*k,"[",i.obj.ID,"]")
-        return list(map(lambda e: e.obj, node.entries))
-
-def tree_objs(tree):
-    return node_objs(tree.root,0)
+#Analisis del arbol (profundidad, fan-out, llenado, radios, solapamiento y
+#fat-factor, ver MTree.analyze) guardado en JSON: sin imprimir cada nodo
+def analisis_arbol(tree, path = 'Pandas.analysis.json'):
+    reporte = tree.analyze()
+    with open(path, 'w') as f:
+        json.dump(reporte, f, indent = 2)
+    print("altura: " + str(reporte['height']) + ", nodos: " + str(reporte['nodes']) + ", hojas: " + str(reporte['leaves']))
+    print("solapamiento entre hermanos: " + str(round(reporte['overlap']['ratio'], 3)) + ", fat-factor: " + str(round(reporte['fat_factor'], 3)))
+    print("analisis completo en " + path)
+    return reporte
+
+#Reads the dataset with one columnar pass: decimal commas are parsed by
+#read_csv, the missing values are set to 0 and the SARS-Cov-2 result is mapped
+#to 0 (negative) / 1 (positive). Returns the array of the patient IDs and the
+#matrix of the 11 numeric attributes (the a..k of point), one row per patient.
+def load_dataset(path, dtype = np.float64):
+    dataset = pd.read_csv(path, decimal = ',')
+    Pacient_ID = dataset.iloc[:, 0].to_numpy()
+    features = np.empty((len(dataset), 11), dtype)
+    features[:, 0] = dataset.iloc[:, 1].to_numpy() != "negative"
+    features[:, 1:] = dataset.iloc[:, 2:12].fillna(0).to_numpy(dtype)
+    return Pacient_ID, features
 
 def main():
 
-    mtree = MTree(distance_manhat , max_node_size = 12)
-
-    dataset = pd.read_csv('Pandas.csv')
-    Pacient_ID = dataset.iloc[:, [0]].values
-    SARS = dataset.iloc[:, [1]].values
-    Age_quantile = dataset.iloc[:, [2]].values
-    Hematocrit = dataset.iloc[:, [3]].values
-    Platelets = dataset.iloc[:, [4]].values
-    Platelet_volume = dataset.iloc[:, [5]].values
-    MCHC = dataset.iloc[:, [6]].values
-    Leukocytes = dataset.iloc[:, [7]].values
-    Basophils = dataset.iloc[:, [8]].values
-    Eosinophils = dataset.iloc[:, [9]].values
-    Monocytes = dataset.iloc[:, [10]].values
-    Proteina_C = dataset.iloc[:, [11]].values
-
-    puntos = []
-    for i in range(len(Pacient_ID)):
-        for j in range(len(Pacient_ID[i])):
-
-            ##Hematocritos c)
-            _Hematocrit=0
-            if(not pd.isnull(Hematocrit[i][j])):
-                _Hematocrit = cast(Hematocrit[i][j]) 
-
-            ##Platelets d)
-            _Platelets=0
-            if(not pd.isnull(Platelets[i][j])):
-                _Platelets = cast(Platelets[i][j])
-
-            ##Platelet_volume e)
-            _Platelet_volume=0
-            if(not pd.isnull(Platelet_volume[i][j])):
-                _Platelet_volume = cast(Platelet_volume[i][j])    
-                      
-            ##MCHC f)
-            _MCHC=0
-            if(not pd.isnull(MCHC[i][j])):
-                _MCHC = cast(MCHC[i][j])  
-
-            ##Leukocytes g)
-            _Leukocytes=0
-            if(not pd.isnull(Leukocytes[i][j])):
-               _Leukocytes = cast(Leukocytes[i][j])   
-
-            ##Basophils h)
-            _Basophils=0
-            if(not pd.isnull(Basophils[i][j])):
-               _Basophils = cast(Basophils[i][j])  
+    if os.path.exists('Pandas.mtree') and os.path.getmtime('Pandas.mtree') >= os.path.getmtime('Pandas.csv'):
+        #the snapshot is up to date: no need to read the CSV nor to build the tree
+        inicio = time.time()
+        mtree = MTree.load('Pandas.mtree', distance_manhat)
+        print("####################### CONSTRUCCION ###############################")
+        print("cargado de Pandas.mtree: " + str(round(time.time() - inicio, 3)) + " s")
+        analisis_arbol(mtree)
+    else:
+        mtree = MTree(distance_manhat , max_node_size = 12)
 
-            ##Eosinophils i)
-            _Eosinophils=0
-            if(not pd.isnull(Eosinophils[i][j])):
-                _Eosinophils = cast(Eosinophils[i][j])  
+        Pacient_ID, features = load_dataset('Pandas.csv')
+        puntos = [point(ID, *row) for ID, row in zip(Pacient_ID, features.tolist())]
 
-            ##_Monocytes j)
-            _Monocytes=0
-            if(not pd.isnull(Monocytes[i][j])):
-                _Monocytes = cast(Monocytes[i][j])  
-                 
-            ##_Proteina_C k)
-            _Proteina_C=0
-            if(not pd.isnull(Proteina_C[i][j])):
-                _Proteina_C = cast(Proteina_C[i][j])     
-                
-            puntos.append(point(Pacient_ID[i][j],SARS[i][j],float(Age_quantile[i][j]),_Hematocrit,_Platelets,_Platelet_volume,_MCHC,_Leukocytes,_Basophils,_Eosinophils,_Monocytes,_Proteina_C))
-        
+        #la comparacion con la insercion uno por uno esta en benchmark.py (--build incremental)
+        bulk = mtree.add_all(puntos)
+        mtree.save('Pandas.mtree')
+        analisis_arbol(mtree)
 
-    for objects in puntos:
-        mtree.add(objects)
-    tree_objs(mtree)
+        print("####################### CONSTRUCCION ###############################")
+        print("bulk-loading: " + str(bulk.distance_calls) + " distancias, " + str(round(bulk.seconds, 3)) + " s")
+    print("memoria: " + str(round(mtree.memory_footprint()['bytes_per_object'])) + " bytes por objeto")
 
 
     print("####################### RANGE QUERIES ###############################")
     _paciente = input("Pacient_ID: ")
-    _sars = float(input("SARS: "))
+    _sars = float(input("SARS (0 = negative, 1 = positive): "))
     _age_quantile = float(input("Age_quantile: "))
     _hematocrit = float(input("Hematocrit: "))
     _platelets = float(input("Platelets: "))
@@ -156,15 +105,15 @@ def main():
 
     new_point_paciente = point(_paciente, _sars , _age_quantile , _hematocrit , _platelets , _platelet_volume , _mchc , _leukocytes , _basophils , _eosinophils , _monocytes , _proteina_c )
 
-    querie = mtree.search_in_radius(new_point_paciente, radio)
+    querie = mtree.search_in_radius_iter(new_point_paciente, radio, sort = True)
 
     cont = 0
     print("Pacient_ID \t SARS \t Age_quantile \t Hematocrit \t Platelets \t Platelet_volume  \t MCHC \t Leukocytes \t Basophils \t Eosinophils \t Monocytes  \t Monocytes \t Proteina_C")
-    for obj in querie:
-        if(obj is not None):
-            print(str(obj.ID) + "\t" + str(obj.a) + "\t" + str(obj.b) + "\t" + str(obj.c) + "\t" + str(obj.d) + "\t" + str(obj.e) + "\t" + str(obj.f) + "\t" + str(obj.g) + "\t" + str(obj.h) + "\t" + str(obj.i) + "\t" + str(obj.j) + "\t" + str(obj.k))
-            cont+=1
+    for obj, distancia in querie:
+        print(str(obj.ID) + "\t" + str(obj.a) + "\t" + str(obj.b) + "\t" + str(obj.c) + "\t" + str(obj.d) + "\t" + str(obj.e) + "\t" + str(obj.f) + "\t" + str(obj.g) + "\t" + str(obj.h) + "\t" + str(obj.i) + "\t" + str(obj.j) + "\t" + str(obj.k))
+        cont+=1
     print("OBJETOS EN EL RADIO DE CONSULTA SON: " + str(cont))
     print("object-found")
     
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
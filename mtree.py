@@ -1,13 +1,34 @@
 __all__ = ['MTree', 'M_LB_DIST_confirmed', 'M_LB_DIST_non_confirmed',
-           'generalized_hyperplane']
+           'mM_RAD', 'mM_RAD_sampled', 'RANDOM', 'SAMPLING',
+           'generalized_hyperplane', 'balanced_partition', 'L1', 'L2', 'WeightedL1', 'Row',
+           'FlatMTree']
 
 __version__ = '1.0.0'
 
 import abc
-from heapq import heappush, heappop
+from array import array
+from heapq import heapify, heappush, heappop, heapreplace
 import collections
+import functools
+import inspect
+import itertools
 from itertools import combinations, islice
-from math import sqrt
+import json
+from math import isqrt, sqrt
+import multiprocessing
+from operator import attrgetter, itemgetter
+import os
+import pickle
+import random
+import struct
+import sys
+import tempfile
+import time
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    np = None
 
 def M_LB_DIST_confirmed(entries, current_routing_entry, d):
     if current_routing_entry is None or \
@@ -26,168 +47,2153 @@ def M_LB_DIST_non_confirmed(entries, unused_current_routing_entry, d):
     objs = map(lambda e: e.obj, entries)
     return max(combinations(objs, 2), key=lambda two_objs: d(*two_objs))
 
+#Promotions minimizing the larger of the two covering radii obtained by
+#assigning each entry to the nearer routing object (M-Tree paper 3.4).
+#mM_RAD tries all the pairs of objects of the node (quadratic in distances),
+#mM_RAD_sampled only sample_size random pairs and SAMPLING all the pairs of
+#sample_size random objects. RANDOM picks any two objects without computing
+#a distance. The sample size (and rng, a random.Random drawing the samples,
+#by default the one of the MTree, see its seed) is set with functools.partial:
+#   MTree(d, 64, promote=functools.partial(SAMPLING, sample_size=8))
+def mM_RAD(entries, unused_current_routing_entry, d):
+    objs = [e.obj for e in entries]
+    return _min_max_radius(combinations(objs, 2), entries, d)
+
+def mM_RAD_sampled(entries, unused_current_routing_entry, d, sample_size=10,
+                   rng=random):
+    objs = [e.obj for e in entries]
+    pairs = combinations(objs, 2)
+    total = len(objs) * (len(objs) - 1) // 2
+    if total > sample_size:
+        pairs = ((objs[i], objs[j]) for i, j in
+                 (_pair(k, len(objs)) for k in
+                  sorted(rng.sample(range(total), sample_size))))
+    return _min_max_radius(pairs, entries, d)
+
+#The pair (i, j) of index k in the order of combinations(range(n), 2),
+#without enumerating the pairs before it
+def _pair(k, n):
+    #counted from the end, the rows of pairs (i, ...) hold 1, 2, 3... pairs
+    i = n - 2 - (isqrt(8 * (n * (n - 1) // 2 - 1 - k) + 1) - 1) // 2
+    return i, k - i * (2 * n - i - 1) // 2 + i + 1
+
+def RANDOM(entries, unused_current_routing_entry, unused_d, rng=random):
+    return tuple(e.obj for e in rng.sample(list(entries), 2))
+
+def SAMPLING(entries, unused_current_routing_entry, d, sample_size=5,
+             rng=random):
+    entries = list(entries)
+    sample = rng.sample(entries, min(max(sample_size, 2), len(entries)))
+    return _min_max_radius(combinations([e.obj for e in sample], 2),
+                           entries, d)
+
+#True if promote has an rng parameter not already bound by functools.partial
+def _takes_rng(promote):
+    if isinstance(promote, functools.partial) and 'rng' in promote.keywords:
+        return False
+    try:
+        return 'rng' in inspect.signature(promote).parameters
+    except (TypeError, ValueError):
+        return False
+
+def _min_max_radius(pairs, entries, d):
+    best, best_radius = None, float('inf')
+    for routing_object1, routing_object2 in pairs:
+        radius1 = radius2 = 0
+        for e in entries:
+            d1 = d(e.obj, routing_object1)
+            d2 = d(e.obj, routing_object2)
+            #leaf entries have no radius
+            extent = e.radius or 0
+            if d1 <= d2:
+                radius1 = max(radius1, d1 + extent)
+            else:
+                radius2 = max(radius2, d2 + extent)
+            if max(radius1, radius2) >= best_radius:
+                break
+        else:
+            best, best_radius = (routing_object1, routing_object2), \
+                max(radius1, radius2)
+    return best
+
 #If the routing objects are not in entries it is possible that
 #all the elements are in one set and the other set is empty.
 def generalized_hyperplane(entries, routing_object1, routing_object2, d):
-    partition = (set(), set())
+    partition = ([], [])
     for entry in entries:
         partition[d(entry.obj, routing_object1) > \
-                         d(entry.obj, routing_object2)].add(entry)
+                         d(entry.obj, routing_object2)].append(entry)
 
     if not partition[0] or not partition[1]:
         #all objects have been put on the same routing_object
         #can only happen if all objects are the same point (d() always 0)
         #fix by splitting the group in two
-        partition = (set(islice(entries, len(entries)//2)),
-                     set(islice(entries, len(entries)//2, len(entries))))
+        partition = (list(islice(entries, len(entries)//2)),
+                     list(islice(entries, len(entries)//2, len(entries))))
+
+    return partition
 
+#Balanced distribution (M-Tree paper 3.4): the routing objects take in turn
+#the nearest of the remaining entries, the two sets differ by at most one
+#entry whatever the distribution of the objects
+def balanced_partition(entries, routing_object1, routing_object2, d):
+    partition = ([], [])
+    by_distance = [sorted(entries, key=lambda e: d(e.obj, routing_object))
+                   for routing_object in (routing_object1, routing_object2)]
+    positions = [0, 0]
+    assigned = set()
+    for turn in range(len(entries)):
+        side = turn % 2
+        candidates = by_distance[side]
+        while candidates[positions[side]] in assigned:
+            positions[side] += 1
+        entry = candidates[positions[side]]
+        assigned.add(entry)
+        partition[side].append(entry)
     return partition
 
 
+#Vectorized metrics: the objects are vectors (rows of a numpy matrix) and
+#batch(objs, obj) computes the distances from all the rows of the matrix objs
+#to obj with a single numpy call. An MTree using one of them keeps the objects
+#of each node in a contiguous matrix of the given dtype and computes all the
+#distances of a node at once. Any other callable is used one pair at a time.
+class VectorMetric(object):
+    def __init__(self, dtype='float64'):
+        if np is None: # pragma: no cover
+            raise ImportError('vectorized metrics require numpy')
+        self.dtype = np.dtype(dtype)
+
+    def __call__(self, obj1, obj2):
+        return float(self.batch(np.asarray(obj1, self.dtype)[None, :], obj2)[0])
+
+    def __repr__(self):
+        return '%s(dtype=%r)' % (self.__class__.__name__, self.dtype.name)
+
+    @abc.abstractmethod
+    def batch(self, objs, obj): # pragma: no cover
+        pass
+
+class L1(VectorMetric):
+    def batch(self, objs, obj):
+        return np.abs(objs - obj).sum(axis=1)
+
+class L2(VectorMetric):
+    def batch(self, objs, obj):
+        diff = objs - obj
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+class WeightedL1(VectorMetric):
+    def __init__(self, weights, dtype='float64'):
+        VectorMetric.__init__(self, dtype)
+        self.weights = np.asarray(weights, self.dtype)
+        if (self.weights < 0).any():
+            raise ValueError('weights must be >= 0')
+
+    def __repr__(self):
+        return 'WeightedL1(%r, dtype=%r)' % (self.weights.tolist(),
+                                             self.dtype.name)
+
+    def batch(self, objs, obj):
+        return np.abs(objs - obj).dot(self.weights)
+
+
+#Compact record of the vectorized mode: a view on the row index of a feature
+#matrix shared by all the rows, with an optional identifier
+class Row(object):
+    __slots__ = ('data', 'index', 'id')
+
+    def __init__(self, data, index, id=None):
+        self.data = data
+        self.index = index
+        self.id = id
+
+    @property
+    def vector(self):
+        return self.data[self.index]
+
+    def __array__(self, dtype=None, copy=None):
+        vector = self.data[self.index]
+        return vector if dtype is None else vector.astype(dtype, copy=False)
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __repr__(self):
+        return 'Row(%r, id=%r)' % (self.index, self.id)
+
+#matrix whose rows are the vectors of objs (vectors or Rows)
+def _stack(objs, dtype):
+    data = getattr(objs[0], 'data', None) if objs else None
+    if data is not None and \
+            all(type(obj) is Row and obj.data is data for obj in objs):
+        return np.asarray(data[[obj.index for obj in objs]], dtype)
+    return np.array([np.asarray(obj) for obj in objs], dtype)
+
+
 class MTree(object):
     def __init__(self,
                  d,
                  max_node_size,
                  promote=M_LB_DIST_confirmed,
-                 partition=generalized_hyperplane):
+                 partition=generalized_hyperplane,
+                 seed=None,
+                 collapse_duplicates=False,
+                 epsilon=0):
         if not callable(d):
             raise TypeError('d is not a function')
         if max_node_size < 2:
             raise ValueError('max_node_size must be >= 2 but is %d' %
                              max_node_size)
         self.d = d
+        #in vectorized mode the distances of a node are computed all at once
+        self.vectorized = callable(getattr(d, 'batch', None))
+        self.dtype = getattr(d, 'dtype', None)
         self.max_node_size = max_node_size
         self.promote = promote
         self.partition = partition
         self.size = 0
         self.root = LeafNode(self)
+        #a Stats while instrumentation is enabled, see enable_stats
+        self.stats = None
+        #the objects chosen by select_pivots
+        self.pivots = None
+        #a QueryCache while caching is enabled, see enable_cache
+        self.cache = None
+        #draws the samples of the bulk-loading, of select_pivots and of the
+        #promotions taking an rng: with a seed, adding the same objects in
+        #the same order gives the same tree
+        self.rng = random.Random(seed)
+        self._promote_rng = _takes_rng(promote)
+        #with collapse_duplicates, an object within epsilon of the object of
+        #a leaf entry is not given its own entry but appended to the
+        #duplicates of that entry. The covering radii do not include the
+        #duplicates: with epsilon > 0 the queries search epsilon farther and
+        #compute the distance of each duplicate of the entries they reach,
+        #with epsilon 0 a duplicate is at the distance of its entry's object
+        self.collapse_duplicates = collapse_duplicates
+        self.epsilon = epsilon
+        #{_query_key(obj): leaf entry} finding the exact duplicates without
+        #computing distances, built when first needed
+        self._duplicate_index = None
 
     def __len__(self):
         return self.size
 
     def add(self, obj):
-        self.root.add(obj)
+        if self.cache is not None:
+            self.cache.invalidate(obj, self.d)
+        if self.stats is None:
+            self._add(obj)
+        else:
+            d = self.d
+            self.d = counter = _CountingDistance(d)
+            try:
+                self._add(obj)
+            finally:
+                self.d = d
+            self.stats.adds += 1
+            self.stats.add_distance_calls += counter.calls
         self.size += 1
 
-    def add_all(self, iterable):
-        #TODO: implement using the bulk-loading algorithm
-        for obj in iterable:
-            self.add(obj)
+    def _add(self, obj):
+        if not self.collapse_duplicates:
+            self.root.add(obj)
+            return
+        entry, key = self._find_duplicate(obj)
+        if entry is None:
+            entry = self.root.add(obj)
+            if key is not None:
+                self._duplicate_index[key] = entry
+        elif entry.duplicates is None:
+            entry.duplicates = [obj]
+        else:
+            entry.duplicates.append(obj)
+
+    #the leaf entry whose object is within epsilon of obj (None if there is
+    #none) and the key of obj in _duplicate_index. With epsilon 0 the objects
+    #with a key (see _query_key) are looked up in the index, the others by a
+    #range query
+    def _find_duplicate(self, obj):
+        key = _query_key(obj) if self.epsilon <= 0 else None
+        if key is not None:
+            if self._duplicate_index is None:
+                self._duplicate_index = {}
+                for entry in self._leaf_entries():
+                    entry_key = _query_key(entry.obj)
+                    if entry_key is not None:
+                        self._duplicate_index[entry_key] = entry
+            return self._duplicate_index.get(key), key
+        return self._search_duplicate(obj), None
+
+    def _search_duplicate(self, obj):
+        stack = [(self.root, 0)]
+        while stack:
+            node, d_parent_query = stack.pop()
+            for entry, d_entry_query in node.matches(obj, self.epsilon,
+                                                     d_parent_query):
+                if entry.subtree is None:
+                    return entry
+                stack.append((entry.subtree, d_entry_query))
+        return None
+
+    #how far the duplicates of a leaf entry can be from its object: the
+    #widening of the balls and of the search radii of the queries
+    def _duplicate_slack(self):
+        return self.epsilon if self.collapse_duplicates else 0
+
+    #(obj, d(obj, query_obj)) for the objects of the leaf entry, at
+    #d_entry_query of query_obj, within distance of it. With a slack the
+    #distances of the duplicates are computed (and counted in record)
+    def _entry_matches(self, entry, d_entry_query, query_obj, distance,
+                       record=None):
+        if d_entry_query <= distance:
+            yield entry.obj, d_entry_query
+        if not entry.duplicates:
+            return
+        if not self._duplicate_slack():
+            for dup in entry.duplicates:
+                yield dup, d_entry_query
+            return
+        if record is not None:
+            record.distance_calls += len(entry.duplicates)
+        for dup in entry.duplicates:
+            d_dup_query = self.d(dup, query_obj)
+            if d_dup_query <= distance:
+                yield dup, d_dup_query
+
+    def _leaf_entries(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for entry in node.entries:
+                if entry.subtree is None:
+                    yield entry
+                else:
+                    stack.append(entry.subtree)
+
+    #Caching of the results of search and search_in_radius, see QueryCache.
+    #Cached results stay exact: add, remove and update evict the entries
+    #whose result the object can change
+    def enable_cache(self, max_entries=1024, max_bytes=None, key=None):
+        self.cache = QueryCache(max_entries, max_bytes, key)
+        return self.cache
+
+    def disable_cache(self):
+        cache, self.cache = self.cache, None
+        return cache
+
+    #Instrumentation: while enabled, the queries and the insertions record
+    #what they cost in the returned Stats (also available as self.stats).
+    #When disabled the only overhead is a test per visited node.
+    def enable_stats(self):
+        self.stats = Stats()
+        return self.stats
+
+    def disable_stats(self):
+        stats, self.stats = self.stats, None
+        return stats
+
+    def remove(self, obj):
+        #removes obj: the entry holding this very object or, if there is
+        #none, an object at distance 0 of it. ValueError if there is neither
+        leaf, entry, stored = self._locate(obj)
+        if entry.duplicates:
+            self._remove_duplicate(leaf, entry, stored)
+        else:
+            self._remove_entry(leaf, entry)
+
+    def update(self, old, new):
+        #replaces old (found as in remove) by new. The entry is rewritten in
+        #place when new is inside the covering radii above it, otherwise old
+        #is removed and new added
+        if self.collapse_duplicates:
+            self.remove(old)
+            self.add(new)
+            return
+        leaf, entry, _ = self._locate(old)
+        distance_to_parent = None
+        node = leaf
+        while node.parent_entry is not None:
+            distance = self.d(new, node.parent_entry.obj)
+            if distance > node.parent_entry.radius:
+                break
+            if node is leaf:
+                distance_to_parent = distance
+            node = node.parent_node
+        else:
+            if self.cache is not None:
+                self.cache.invalidate(entry.obj, self.d)
+                self.cache.invalidate(new, self.d)
+            entry.obj = new
+            entry.distance_to_parent = distance_to_parent
+            if self.pivots is not None:
+                entry.pivot_distances = self._pivot_distances_for(new)
+            leaf._block = None
+            return
+        self._remove_entry(leaf, entry)
+        self.add(new)
+
+    def _locate(self, obj):
+        #the leaf, the entry and the stored object (entry.obj or one of its
+        #duplicates) that is obj itself or, if there is none, at distance 0
+        #of obj, see remove
+        found = None
+        #an object collapsed into an entry is within epsilon of its object
+        radius = self.epsilon if self.collapse_duplicates else 0
+        stack = [(self.root, 0)]
+        while stack:
+            node, d_parent_query = stack.pop()
+            for entry, d_entry_query in node.matches(obj, radius,
+                                                     d_parent_query):
+                if entry.subtree is not None:
+                    stack.append((entry.subtree, d_entry_query))
+                    continue
+                for stored in _entry_objects(entry):
+                    if stored is obj:
+                        return node, entry, stored
+                if found is not None:
+                    continue
+                if d_entry_query == 0:
+                    found = (node, entry, entry.obj)
+                elif entry.duplicates:
+                    for dup in entry.duplicates:
+                        if self.d(dup, obj) == 0:
+                            found = (node, entry, dup)
+                            break
+        if found is None:
+            raise ValueError('%r is not in the tree' % (obj,))
+        return found
+
+    #removes obj, which is entry.obj or one of its duplicates (the very
+    #object), from the objects of entry
+    def _remove_duplicate(self, leaf, entry, obj):
+        if self.cache is not None:
+            self.cache.invalidate(obj, self.d)
+        duplicates = entry.duplicates
+        if entry.obj is not obj:
+            for i, dup in enumerate(duplicates):
+                if dup is obj:
+                    del duplicates[i]
+                    break
+        else:
+            equal = [i for i, dup in enumerate(duplicates)
+                     if self.d(dup, obj) == 0]
+            if equal:
+                #a duplicate equal to obj takes its place, the distances
+                #and the radii stay the same
+                entry.obj = duplicates.pop(equal[0])
+                leaf._block = None
+                if not duplicates:
+                    entry.duplicates = None
+                self.size -= 1
+                return
+            #the duplicates are within epsilon of obj, not necessarily of
+            #each other: the first one is promoted to a new entry by adding
+            #them again
+            entry.duplicates = None
+            self._remove_entry(leaf, entry)
+            self.size -= len(duplicates)
+            for dup in duplicates:
+                self.add(dup)
+            return
+        if not duplicates:
+            entry.duplicates = None
+        self.size -= 1
+
+    def _remove_entry(self, leaf, entry):
+        if self.cache is not None:
+            self.cache.invalidate(entry.obj, self.d)
+        if self._duplicate_index is not None:
+            key = _query_key(entry.obj)
+            if self._duplicate_index.get(key) is entry:
+                del self._duplicate_index[key]
+        leaf.remove_entry(entry)
+        self.size -= 1
+        _shrink_radii(leaf)
+        _fix_underflow(leaf)
+
+    def add_all(self, iterable, bulk_load=True, ids=None):
+        #bulk-loading is only possible on an empty tree, otherwise the objects
+        #are inserted one at a time.
+        #returns a BuildStats so both strategies can be compared
+        if self.vectorized and getattr(iterable, 'ndim', None) == 2:
+            #the objects are Rows of one contiguous matrix, identified by ids
+            data = np.ascontiguousarray(iterable, self.dtype)
+            iterable = [Row(data, i, None if ids is None else ids[i])
+                        for i in range(len(data))]
+        objs = list(iterable)
+        if self.cache is not None:
+            self.cache.clear()
+        counter = _CountingDistance(self.d)
+        start = time.perf_counter()
+        self.d = counter
+        try:
+            if bulk_load and self.size == 0:
+                if self.collapse_duplicates:
+                    self._bulk_load_collapsed(objs)
+                else:
+                    _bulk_load(self, objs, self.rng)
+                self.size = len(objs)
+                if self.pivots is not None:
+                    self._set_pivot_distances()
+            else:
+                for obj in objs:
+                    self.add(obj)
+        finally:
+            self.d = counter.d
+        return BuildStats(len(objs), counter.calls, time.perf_counter() - start)
+
+    #Bulk-loading of the first object of each group of duplicates (see
+    #_group_duplicates), the others becoming the duplicates of its entry
+    def _bulk_load_collapsed(self, objs):
+        groups = self._group_duplicates(objs)
+        _bulk_load(self, [group[0] for group in groups], self.rng)
+        group_of = dict((id(group[0]), group) for group in groups)
+        for entry in self._leaf_entries():
+            if len(group_of[id(entry.obj)]) > 1:
+                entry.duplicates = group_of[id(entry.obj)][1:]
+        self._duplicate_index = None
+
+    #objs as lists of duplicates, the first one being the representative.
+    #Objects with the same key (see _query_key: equal vectors, or equal
+    #objects hashed by value) are taken as duplicates without computing
+    #their distance. When epsilon > 0 or some objects have no key, the
+    #groups are then merged around leaders: in order, each group not yet
+    #merged takes the groups whose first object is within epsilon of its
+    #own, found in a temporary tree of the first objects
+    def _group_duplicates(self, objs):
+        groups, by_key = [], {}
+        unkeyed = False
+        for obj in objs:
+            key = _query_key(obj)
+            group = None if key is None else by_key.get(key)
+            if group is not None:
+                group.append(obj)
+                continue
+            groups.append([obj])
+            if key is None:
+                unkeyed = True
+            else:
+                by_key[key] = groups[-1]
+        if len(groups) < 2 or self.epsilon <= 0 and not unkeyed:
+            return groups
+
+        leaders = MTree(self.d, self.max_node_size)
+        _bulk_load(leaders, [group[0] for group in groups], self.rng)
+        group_of = dict((id(group[0]), group) for group in groups)
+        merged, taken = [], set()
+        for group in groups:
+            if id(group[0]) in taken:
+                continue
+            taken.add(id(group[0]))
+            for obj, _ in leaders._range(group[0], self.epsilon):
+                if id(obj) not in taken:
+                    taken.add(id(obj))
+                    group.extend(group_of[id(obj)])
+            merged.append(group)
+        return merged
+
+    def memory_footprint(self):
+        #approximate memory used by the tree, in bytes: the nodes (with their
+        #lists of entries and matrices of the vectorized mode), the entries and
+        #the indexed objects (shared matrices are counted once)
+        seen = set()
+        report = collections.OrderedDict(
+            (key, 0) for key in ('nodes', 'entries', 'objects'))
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            report['nodes'] += sys.getsizeof(node) + \
+                sys.getsizeof(node.entries)
+            if node._block is not None:
+                entries, block, radii, pivots = node._block
+                report['nodes'] += sys.getsizeof(node._block) + \
+                    sys.getsizeof(entries) + _sizeof(block, seen) + \
+                    _sizeof(radii, seen) + _sizeof(pivots, seen)
+            for entry in node.entries:
+                report['entries'] += sys.getsizeof(entry)
+                for value in (entry.distance_to_parent, entry.radius,
+                              entry.pivot_distances):
+                    report['entries'] += _sizeof(value, seen)
+                if entry.subtree is not None:
+                    stack.append(entry.subtree)
+                else:
+                    report['objects'] += _sizeof(entry.obj, seen)
+                    if entry.duplicates:
+                        report['entries'] += sys.getsizeof(entry.duplicates)
+                        report['objects'] += sum(_sizeof(dup, seen)
+                                                 for dup in entry.duplicates)
+        report['total'] = sum(report.values())
+        report['objects_count'] = len(self)
+        report['bytes_per_object'] = report['total'] / float(len(self)) \
+            if len(self) else 0.0
+        return report
+
+    #Snapshot format (version 1): a preamble (magic, version, length of the
+    #header), a JSON header and sections aligned on 64 bytes. The topology,
+    #radii and distances to the parent are flat arrays (nodes in breadth-first
+    #order, the entries of a node are contiguous, node 0 is the root, NaN
+    #stands for None), the objects are either a matrix of vectors plus their
+    #pickled ids (vectorized mode) or a pickled list.
+    def save(self, path):
+        if np is None: # pragma: no cover
+            raise ImportError('snapshots require numpy')
+        objects, node_leaf, node_first, node_count, entry_object, \
+            entry_distance, entry_radius, entry_child, duplicate_offset, \
+            duplicate_object = self._flatten()
+
+        sections = collections.OrderedDict([
+            ('node_leaf', np.array(node_leaf, 'uint8')),
+            ('node_first', np.array(node_first, 'int64')),
+            ('node_count', np.array(node_count, 'int64')),
+            ('entry_object', np.array(entry_object, 'int64')),
+            ('entry_distance', np.array(entry_distance, 'float64')),
+            ('entry_radius', np.array(entry_radius, 'float64')),
+            ('entry_child', np.array(entry_child, 'int64'))])
+        if duplicate_object:
+            sections['duplicate_offset'] = np.array(duplicate_offset, 'int64')
+            sections['duplicate_object'] = np.array(duplicate_object, 'int64')
+        if self.vectorized:
+            sections['vectors'] = _stack(objects, self.dtype) if objects \
+                else np.empty((0, 0), self.dtype)
+            #the vectors again in entry order, the matrix of FlatMTree
+            sections['entry_vectors'] = \
+                sections['vectors'][sections['entry_object']] if objects \
+                else np.empty((0, 0), self.dtype)
+            sections['ids'] = pickle.dumps([getattr(obj, 'id', None)
+                                            for obj in objects], 2)
+        else:
+            sections['objects'] = pickle.dumps(objects, 2)
+
+        specs, offset = collections.OrderedDict(), 0
+        for name, section in sections.items():
+            if isinstance(section, bytes):
+                specs[name] = {'dtype': 'bytes', 'shape': [len(section)],
+                               'offset': offset}
+                offset = _align(offset + len(section))
+            else:
+                specs[name] = {'dtype': section.dtype.str,
+                               'shape': list(section.shape),
+                               'offset': offset}
+                offset = _align(offset + section.nbytes)
+        header = json.dumps({'max_node_size': self.max_node_size,
+                             'size': self.size,
+                             'collapse_duplicates': self.collapse_duplicates,
+                             'epsilon': self.epsilon,
+                             'sections': specs}).encode('utf-8')
+
+        with open(path, 'wb') as f:
+            f.write(_SNAPSHOT_PREAMBLE.pack(_SNAPSHOT_MAGIC,
+                                            _SNAPSHOT_VERSION,
+                                            len(header)))
+            f.write(header)
+            start = _align(f.tell())
+            for name, section in sections.items():
+                f.write(b'\0' * (start + specs[name]['offset'] - f.tell()))
+                f.write(section if isinstance(section, bytes)
+                        else np.ascontiguousarray(section).tobytes())
+
+    #The nodes in breadth-first order (the root first) as parallel lists, and
+    #the objects in order of first appearance. Snapshots are written in this
+    #order, so the object numbers are the same in a tree and its snapshot.
+    #The duplicates of entry e are the objects
+    #duplicate_object[duplicate_offset[e]:duplicate_offset[e+1]].
+    def _flatten(self):
+        nodes, objects, object_index = [self.root], [], {}
+        node_leaf, node_first, node_count = [], [], []
+        entry_object, entry_distance, entry_radius, entry_child = \
+            [], [], [], []
+        duplicate_offset, duplicate_object = [0], []
+
+        def number(obj):
+            if id(obj) not in object_index:
+                object_index[id(obj)] = len(objects)
+                objects.append(obj)
+            return object_index[id(obj)]
+
+        for node in nodes:
+            node_leaf.append(isinstance(node, LeafNode))
+            node_first.append(len(entry_object))
+            node_count.append(len(node.entries))
+            for entry in node.entries:
+                entry_object.append(number(entry.obj))
+                entry_distance.append(entry.distance_to_parent)
+                entry_radius.append(entry.radius)
+                if entry.subtree is None:
+                    entry_child.append(-1)
+                else:
+                    entry_child.append(len(nodes))
+                    nodes.append(entry.subtree)
+                if entry.duplicates:
+                    duplicate_object.extend(number(dup)
+                                            for dup in entry.duplicates)
+                duplicate_offset.append(len(duplicate_object))
+        return (objects, node_leaf, node_first, node_count, entry_object,
+                entry_distance, entry_radius, entry_child, duplicate_offset,
+                duplicate_object)
+
+    #Loads a snapshot written by save. The vectors of the objects are
+    #memory-mapped, not copied, so several processes loading the same file
+    #share them through the page cache, but the nodes and entries are
+    #rebuilt, in time linear in the size of the tree: FlatMTree.load maps
+    #the whole snapshot without rebuilding it. d (and promote and
+    #partition) are not stored in the file and must be given again.
+    @classmethod
+    def load(cls, path, d, promote=M_LB_DIST_confirmed,
+             partition=generalized_hyperplane):
+        return cls._load(path, d, promote, partition)[0]
+
+    #load returning also the objects numbered as in _flatten
+    @classmethod
+    def _load(cls, path, d, promote, partition):
+        header, section = _read_snapshot(path)
+        tree = cls(d, header['max_node_size'], promote, partition,
+                   collapse_duplicates=header.get('collapse_duplicates',
+                                                  False),
+                   epsilon=header.get('epsilon', 0))
+        objects = _snapshot_objects(header, section)
+        duplicate_offset = duplicate_object = None
+        if 'duplicate_object' in header['sections']:
+            duplicate_offset = section('duplicate_offset').tolist()
+            duplicate_object = section('duplicate_object').tolist()
+
+        node_first = section('node_first').tolist()
+        node_count = section('node_count').tolist()
+        entry_object = section('entry_object').tolist()
+        entry_distance = section('entry_distance').tolist()
+        entry_radius = section('entry_radius').tolist()
+        entry_child = section('entry_child').tolist()
+        nodes = [LeafNode(tree) if leaf else InternalNode(tree)
+                 for leaf in section('node_leaf').tolist()]
+        for node, first, count in zip(nodes, node_first, node_count):
+            for e in range(first, first + count):
+                distance, radius = entry_distance[e], entry_radius[e]
+                child = entry_child[e]
+                entry = Entry(objects[entry_object[e]],
+                              None if distance != distance else distance,
+                              None if radius != radius else radius,
+                              nodes[child] if child >= 0 else None)
+                if duplicate_offset is not None and \
+                        duplicate_offset[e] < duplicate_offset[e + 1]:
+                    entry.duplicates = [objects[i] for i in duplicate_object[
+                        duplicate_offset[e]:duplicate_offset[e + 1]]]
+                node.entries.append(entry)
+                if child >= 0:
+                    entry.subtree.parent_node = node
+                    entry.subtree.parent_entry = entry
+        tree.root = nodes[0]
+        tree.size = header['size']
+        return tree, objects
+
+    #LAESA-style filtering: count pivots are chosen among the objects, each
+    #one the farthest object of a sample from the pivots already chosen, and
+    #every entry stores its distances to them. A query computes its own
+    #distances to the pivots once, max |d(q, p) - d(o, p)| over the pivots
+    #is then a lower bound of d(q, o) checked before computing d(q, o).
+    #New objects get their distances to the pivots when they are added.
+    #count=0 removes the pivots. Pivots are not saved in snapshots.
+    def select_pivots(self, count=4, sample_size=1000, rng=None):
+        rng = rng or self.rng
+        objects = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for entry in node.entries:
+                if entry.subtree is None:
+                    objects.append(entry.obj)
+                else:
+                    stack.append(entry.subtree)
+        pivots = []
+        if count > 0 and objects:
+            sample = rng.sample(objects, min(sample_size, len(objects)))
+            pivots.append(sample[0])
+            nearest = [self.d(obj, sample[0]) for obj in sample]
+            while len(pivots) < count:
+                i = max(range(len(sample)), key=nearest.__getitem__)
+                if nearest[i] == 0:
+                    #the remaining objects are copies of the pivots
+                    break
+                pivots.append(sample[i])
+                nearest = [min(distance, self.d(obj, sample[i]))
+                           for distance, obj in zip(nearest, sample)]
+        self.pivots = pivots or None
+        self._set_pivot_distances()
+        return pivots
+
+    def _pivot_distances_for(self, obj, entries=()):
+        #reuses the distances of an entry of the same object if there is one
+        for entry in entries:
+            if entry.obj is obj and entry.pivot_distances is not None:
+                return entry.pivot_distances
+        return array('d', [self.d(obj, pivot) for pivot in self.pivots])
+
+    def _set_pivot_distances(self):
+        known = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            node._block = None
+            for entry in node.entries:
+                if self.pivots is None:
+                    entry.pivot_distances = None
+                else:
+                    if id(entry.obj) not in known:
+                        known[id(entry.obj)] = \
+                            self._pivot_distances_for(entry.obj)
+                    entry.pivot_distances = known[id(entry.obj)]
+                if entry.subtree is not None:
+                    stack.append(entry.subtree)
+
+    #the distances from query_obj to the pivots, None without pivots
+    def _query_pivots(self, query_obj, record):
+        if self.pivots is None:
+            return None
+        if record is not None:
+            record.distance_calls += len(self.pivots)
+        distances = [self.d(query_obj, pivot) for pivot in self.pivots]
+        return np.array(distances) if self.vectorized else distances
 
     def search(self, query_obj, k=1):
+        #nothing to cache (nor a k-th object) when k <= 0
+        key = None if self.cache is None or k <= 0 \
+            else self.cache.key(query_obj, 'knn', k)
+        if key is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                return list(result)
+        result = list(self._knn(query_obj, k)[0])
+        if key is not None:
+            #an object nearer than the k-th one changes the result, any
+            #object does if there are less than k
+            influence = self.d(query_obj, result[-1]) \
+                if len(result) == k \
+                else float('inf')
+            self.cache.put(key, query_obj, influence, result)
+        return list(result)
+
+    #Approximate k-NN: a subtree is skipped when dmin * (1 + eps) is beyond
+    #the distance of the k-th object found (the distance to the k-th result
+    #is then at most (1 + eps) times the true one), and the search stops,
+    #returning the best objects found so far, after max_distance_calls
+    #distance computations or max_ms milliseconds. The budget is checked
+    #before each node is visited, so a node can overshoot max_distance_calls,
+    #and only once the search has descended greedily to a first leaf (at
+    #each level the child nearest to query_obj), so even a tiny budget
+    #returns the best objects of that leaf, at the cost of one root-to-leaf
+    #path.
+    #Returns an ApproximateResult, exact tells whether no pruning or budget
+    #stop could have changed the result.
+    def search_approximate(self, query_obj, k=1, eps=0,
+                           max_distance_calls=None, max_ms=None):
+        budget = None
+        if max_distance_calls is not None or max_ms is not None:
+            budget = _Budget(max_distance_calls, max_ms)
+        objects, exact = self._knn(query_obj, k, eps, budget)
+        return ApproximateResult(objects, exact)
+
+    #Range query under a budget (see search_approximate): the objects within
+    #distance found before the budget ran out, nearest first
+    def search_in_radius_approximate(self, query_obj, distance,
+                                     max_distance_calls=None, max_ms=None):
+        budget = _Budget(max_distance_calls, max_ms)
+        found = sorted(self._range(query_obj, distance, budget),
+                       key=itemgetter(1))
+        return ApproximateResult([obj for obj, _ in found],
+                                 not budget.stopped)
+
+    def _knn(self, query_obj, k, eps=0, budget=None):
+        #returns the k nearest objects and whether they are exact
         k = min(k, len(self))
-        if k == 0: return []
+        if k == 0: return [], True
+
+        #the results
+        nn = NN(k, self._duplicate_slack())
+        #heap of the subtrees not yet explored, as (dmin, order, node,
+        #d(query_obj, routing object of node)), see InternalNode._push
+        pr = [(0, next(nn.order), self.root, 0)]
+        #pr is pruned of the subtrees beyond the search radius when it grows
+        #beyond prune_size
+        prune_size = _KNN_PRUNE_SIZE
+
+        record = self._record('knn')
+        if record is None and budget is not None:
+            record = QueryStats('knn')
+        query_pivots = self._query_pivots(query_obj, record)
+        exact = True
+        #with a budget, until a leaf is searched, the children of each node
+        #are queued apart and the nearest one is searched next
+        descending = budget is not None
+        following = None
+        while pr or following is not None:
+            if following is not None:
+                dmin, _, node, d_query = following
+                following = None
+            elif budget is not None and budget.exhausted(record):
+                exact = pr[0][0] > nn.radius
+                break
+            else:
+                dmin, _, node, d_query = heappop(pr)
+            if dmin * (1 + eps) > nn.radius:
+                #no pending subtree can hold a nearer object (by a factor
+                #1 + eps)
+                exact = dmin > nn.radius
+                if record is not None:
+                    record.radius_pruned += len(pr) + 1
+                break
+            if descending:
+                children = []
+                node.search(query_obj, children, nn, d_query, record,
+                            query_pivots)
+                descending = not isinstance(node, LeafNode)
+                if children:
+                    following = min(children, key=itemgetter(0, 3))
+                    for child in children:
+                        if child is not following:
+                            heappush(pr, child)
+            else:
+                node.search(query_obj, pr, nn, d_query, record, query_pivots)
+            if record is not None and len(pr) > record.peak_queue:
+                record.peak_queue = len(pr)
+            if len(pr) > prune_size:
+                radius = nn.radius
+                kept = [item for item in pr if item[0] <= radius]
+                if record is not None:
+                    record.radius_pruned += len(pr) - len(kept)
+                if len(kept) < len(pr):
+                    pr = kept
+                    heapify(pr)
+                prune_size = max(_KNN_PRUNE_SIZE, 2 * len(pr))
+
+        return nn.result_list(), exact
 
-        #priority queue of subtrees not yet explored ordered by dmin
-        pr = []
-        heappush(pr, PrEntry(self.root, 0, 0))
+    def search_in_radius(self, query_obj, distance):
+        #list of the objects within distance of query_obj, nearest first
+        key = None if self.cache is None \
+            else self.cache.key(query_obj, 'range', distance)
+        if key is not None:
+            result = self.cache.get(key)
+            if result is not None:
+                return list(result)
+        result = [obj for obj, _ in sorted(self._range(query_obj, distance),
+                                           key=itemgetter(1))]
+        if key is not None:
+            self.cache.put(key, query_obj, distance, result)
+        return list(result)
+
+    def search_in_radius_iter(self, query_obj, distance, sort=False,
+                              limit=None):
+        #yields (obj, d(obj, query_obj)) for the objects within distance of
+        #query_obj, as soon as their leaf is reached or, if sort, in
+        #increasing distance order. Stops after limit results if given.
+        #Only the pending subtrees (and, if sort, the pending objects) are
+        #kept, nothing proportional to the size of the tree is allocated
+        results = self._ranking(query_obj, distance) if sort \
+            else self._range(query_obj, distance)
+        return islice(results, limit) if limit is not None else results
+
+    def nearest(self, query_obj, max_distance=float('inf')):
+        #yields (obj, d(obj, query_obj)) for all the objects (within
+        #max_distance) in increasing distance order. The search state is kept
+        #between two next() calls, so asking for more neighbours resumes the
+        #search instead of starting it again
+        return self._ranking(query_obj, max_distance)
+
+    #Similarity joins: the pairs of objects within radius of each other,
+    #streamed as (a, b, d(a, b)) while the two trees are traversed together.
+    #A pair of entries whose balls are within radius is expanded by
+    #replacing the one with the larger covering radius by its children, the
+    #distance of a child to its parent bounding its distance to the other
+    #entry before it is computed. similarity_join gives every pair of
+    #entries of this tree once, join the pairs of an object of this tree (a)
+    #and an object of other (b), which must use the same metric.
+    def similarity_join(self, radius):
+        return self._join(self, radius)
+
+    def join(self, other, radius):
+        return self._join(other, radius)
+
+    def _join(self, other, radius):
+        record = self._record('join')
+        #the entries are matched within search_radius, the duplicates of
+        #both being within their slack of the objects of their entries
+        slack = self._duplicate_slack() + other._duplicate_slack()
+        search_radius = radius + slack
+        #nodes: the nodes whose entries are joined with each other (self
+        #join), pairs: (entry of self, entry of other, distance) to expand
+        nodes, pairs = [], []
+        if other is self:
+            nodes.append(self.root)
+        else:
+            for entry in self.root.entries:
+                pairs.extend((entry, other_entry, distance)
+                             for other_entry, distance in _join_candidates(
+                                 entry, other.root, None, search_radius,
+                                 record))
+        while nodes or pairs:
+            if nodes:
+                node = nodes.pop()
+                nodes.extend(entry.subtree for entry in node.entries
+                             if entry.subtree is not None)
+                #the objects collapsed into an entry, at distance 0 when
+                #there is no slack
+                for entry in node.entries:
+                    if not entry.duplicates:
+                        continue
+                    for a, b in combinations(_entry_objects(entry), 2):
+                        if not slack:
+                            yield a, b, 0
+                            continue
+                        distance = self.d(a, b)
+                        if distance <= radius:
+                            yield a, b, distance
+                    if slack and record is not None:
+                        count = len(entry.duplicates) + 1
+                        record.distance_calls += count * (count - 1) // 2
+                found = _join_within(node, search_radius, record)
+            else:
+                entry1, entry2, distance = pairs.pop()
+                if entry2.subtree is None or entry1.subtree is not None and \
+                        entry1.radius >= entry2.radius:
+                    found = [(child, entry2, child_distance)
+                             for child, child_distance in _join_candidates(
+                                 entry2, entry1.subtree, distance,
+                                 search_radius, record)]
+                else:
+                    found = [(entry1, child, child_distance)
+                             for child, child_distance in _join_candidates(
+                                 entry1, entry2.subtree, distance,
+                                 search_radius, record)]
+            for entry1, entry2, distance in found:
+                if entry1.subtree is not None or entry2.subtree is not None:
+                    pairs.append((entry1, entry2, distance))
+                elif not slack:
+                    for a in _entry_objects(entry1):
+                        for b in _entry_objects(entry2):
+                            yield a, b, distance
+                else:
+                    for a, b, d_a_b in self._join_objects(entry1, entry2,
+                                                          distance, radius,
+                                                          record):
+                        yield a, b, d_a_b
+
+    #the pairs of objects of two leaf entries, at distance of each other,
+    #within radius: the distances of the pairs with a duplicate are computed
+    def _join_objects(self, entry1, entry2, distance, radius, record):
+        for a in _entry_objects(entry1):
+            for b in _entry_objects(entry2):
+                if a is entry1.obj and b is entry2.obj:
+                    d_a_b = distance
+                else:
+                    if record is not None:
+                        record.distance_calls += 1
+                    d_a_b = self.d(a, b)
+                if d_a_b <= radius:
+                    yield a, b, d_a_b
+
+    #Batch versions of search and search_in_radius: the queries are spread
+    #over a pool of processes worker processes (os.cpu_count() by default).
+    #Each worker gets the tree once, inherited through fork or, when fork is
+    #not available or snapshot (the path of a file written by save) is given,
+    #by loading the snapshot (then d, promote and partition must be
+    #picklable). Returns a QueryResult per query, in the order of queries.
+    #With processes <= 1 the queries are run in this process.
+    def search_many(self, queries, k=1, processes=None, snapshot=None):
+        return self._query_many('search', (k,), queries, processes, snapshot)
+
+    def search_in_radius_many(self, queries, distance, processes=None,
+                              snapshot=None):
+        return self._query_many('search_in_radius', (distance,), queries,
+                                processes, snapshot)
+
+    def _query_many(self, method, args, queries, processes, snapshot):
+        global _worker_state
+        queries = list(queries)
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(queries))
+        if processes <= 1:
+            return [_run_query(self, method, args, query)
+                    for query in queries]
+
+        #the results come back as object numbers (see _flatten): objects
+        #(and queries, which may be rows of a big matrix) are not pickled
+        #with their data
+        objects = self._flatten()[0]
+        tasks = [(method, args, _plain_query(query)) for query in queries]
+        chunksize = max(1, len(tasks) // (processes * 4))
+        temporary = None
+        if snapshot is None and \
+                'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            initializer, initargs = None, ()
+            _worker_state = (self, dict((id(obj), i)
+                                        for i, obj in enumerate(objects)))
+        else:
+            if snapshot is None:
+                fd, temporary = tempfile.mkstemp(suffix='.mtree')
+                os.close(fd)
+                self.save(temporary)
+            context = multiprocessing.get_context()
+            initializer = _init_query_worker
+            initargs = (snapshot or temporary, self.d, self.promote,
+                        self.partition)
+        try:
+            with context.Pool(processes, initializer, initargs) as pool:
+                results = pool.map(_query_worker, tasks, chunksize)
+        finally:
+            _worker_state = None
+            if temporary is not None:
+                os.remove(temporary)
+        return [QueryResult([objects[i] for i in numbers], calls, seconds)
+                for numbers, calls, seconds in results]
+
+    #a new QueryStats in self.stats, None if the instrumentation is disabled
+    def _record(self, kind):
+        if self.stats is None:
+            return None
+        record = QueryStats(kind)
+        self.stats.queries.append(record)
+        return record
+
+    #depth-first range query, stopped (budget.stopped set) when the optional
+    #_Budget is exhausted
+    def _range(self, query_obj, distance, budget=None):
+        record = self._record('range')
+        if record is None and budget is not None:
+            record = QueryStats('range')
+        query_pivots = self._query_pivots(query_obj, record)
+        search_radius = distance + self._duplicate_slack()
+        stack = [(self.root, 0)]
+        while stack:
+            if budget is not None and budget.exhausted(record):
+                budget.stopped = True
+                return
+            node, d_parent_query = stack.pop()
+            for entry, d_entry_query in node.matches(query_obj,
+                                                     search_radius,
+                                                     d_parent_query, record,
+                                                     query_pivots):
+                if entry.subtree is None:
+                    for found in self._entry_matches(entry, d_entry_query,
+                                                     query_obj, distance,
+                                                     record):
+                        yield found
+                else:
+                    stack.append((entry.subtree, d_entry_query))
+            if record is not None and len(stack) > record.peak_queue:
+                record.peak_queue = len(stack)
+
+    #best-first traversal yielding (obj, d(obj, query_obj)) in increasing
+    #distance order for the objects within max_distance of query_obj. The
+    #queue holds both subtrees (ordered by dmin) and objects, an object is
+    #yielded when no pending subtree can contain a nearer one
+    def _ranking(self, query_obj, max_distance=float('inf')):
+        record = self._record('ranking')
+        query_pivots = self._query_pivots(query_obj, record)
+        slack = self._duplicate_slack()
+        order = itertools.count()
+        pending = [(0, next(order), self.root, 0)]
+        while pending:
+            if record is not None and len(pending) > record.peak_queue:
+                record.peak_queue = len(pending)
+            dmin, _, node, item = heappop(pending)
+            if node is None:
+                yield item, dmin
+                continue
+            for entry, d_entry_query in node.matches(query_obj,
+                                                     max_distance + slack,
+                                                     item, record,
+                                                     query_pivots):
+                if entry.subtree is None:
+                    for obj, distance in self._entry_matches(
+                            entry, d_entry_query, query_obj, max_distance,
+                            record):
+                        heappush(pending, (distance, next(order), None, obj))
+                else:
+                    heappush(pending, (max(d_entry_query - entry.radius -
+                                           slack, 0),
+                                       next(order), entry.subtree,
+                                       d_entry_query))
+
+    #Slim-down (Traina et al., "Slim-trees: high performance metric trees
+    #minimizing overlap between nodes"): the object of a leaf that is the
+    #farthest from its routing object is moved into a sibling leaf (a leaf
+    #of the same parent) whose ball already covers it and that has room,
+    #which shrinks the covering radius of the leaf, until no leaf can give
+    #its farthest object or after max_passes passes over the leaves. A leaf
+    #keeps at least max_node_size / 2 entries. The covering radii of the
+    #internal nodes are then recomputed bottom-up: with tight_radii, as the
+    #largest distance from the routing object to an object of its subtree,
+    #otherwise as the bound given by the distances to the parents (no
+    #distance computed).
+    #Returns an OptimizeStats with the fat-factor before and after.
+    def optimize(self, max_passes=10, tight_radii=True):
+        fat_factor_before = self.fat_factor()
+        counter = _CountingDistance(self.d)
+        start = time.perf_counter()
+        self.d = counter
+        moved = 0
+        try:
+            for _ in range(max_passes):
+                moves = sum(_slim_down_children(node)
+                            for node in self._leaf_parents())
+                moved += moves
+                if not moves:
+                    break
+            _tighten_radii(self.root, tight_radii)
+        finally:
+            self.d = counter.d
+        seconds = time.perf_counter() - start
+        return OptimizeStats(moved, fat_factor_before, self.fat_factor(),
+                             counter.calls, seconds)
+
+    #Fat-factor of the tree (Traina et al.): (I - H * N) / (N * (M - H))
+    #where I is the number of nodes read by the point queries of the N
+    #objects of the leaf entries, H the height of the tree and M its number
+    #of nodes. 0 when a point query reads a single node per level, 1 when it
+    #reads every node.
+    #The point queries are run together: each node is given the objects
+    #whose query reads it, and passes to each child those in its ball
+    def fat_factor(self):
+        nodes = height = 0
+        for _, depth in self.walk():
+            nodes += 1
+            height = max(height, depth + 1)
+        objs = [entry.obj for entry in self._leaf_entries()]
+        if not objs or nodes == height:
+            return 0.0
+        reads = 0
+        if self.vectorized:
+            block = _stack(objs, self.dtype)
+            stack = [(self.root, np.arange(len(objs)))]
+            while stack:
+                node, reached = stack.pop()
+                reads += len(reached)
+                if isinstance(node, LeafNode):
+                    continue
+                for entry in node.entries:
+                    distances = self.d.batch(block[reached], entry.obj)
+                    inside = reached[distances - _ROUNDING_SLACK <=
+                                     entry.radius]
+                    if len(inside):
+                        stack.append((entry.subtree, inside))
+        else:
+            #(object, its distance to the routing object of the node)
+            stack = [(self.root, [(obj, 0) for obj in objs])]
+            while stack:
+                node, reached = stack.pop()
+                reads += len(reached)
+                if isinstance(node, LeafNode):
+                    continue
+                for entry in node.entries:
+                    inside = []
+                    for obj, d_parent in reached:
+                        if not node.could_contain_results(obj, 0, entry,
+                                                          d_parent):
+                            continue
+                        distance = self.d(obj, entry.obj)
+                        if distance - _ROUNDING_SLACK <= entry.radius:
+                            inside.append((obj, distance))
+                    if inside:
+                        stack.append((entry.subtree, inside))
+        return (reads - height * len(objs)) / float(len(objs) *
+                                                     (nodes - height))
+
+    #Depth-first traversal without recursion: yields (node, depth) lazily,
+    #the root at depth 0, each node before its children
+    def walk(self):
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            stack.extend((entry.subtree, depth + 1)
+                         for entry in reversed(node.entries)
+                         if entry.subtree is not None)
+
+    #Shape of the tree as a dict of numbers, lists and dicts (json.dump can
+    #write it), computed on walk:
+    # - depth: the nodes per depth and the leaves per depth (a single depth
+    #   in a balanced tree)
+    # - fan_out: the internal nodes per number of children
+    # - fill: the nodes per percentage of max_node_size used, by tenths
+    # - radii: the distribution of the covering radii per depth of the
+    #   nodes they cover, zero counting the balls of identical objects
+    # - overlap: the pairs of sibling balls that intersect
+    #   (d(o1, o2) < r1 + r2), their ratio to all the pairs of siblings and
+    #   their mean relative overlap (r1 + r2 - d(o1, o2)) / (r1 + r2). It
+    #   costs the distances between the siblings
+    # - fat_factor: see fat_factor, None unless fat_factor is True as it
+    #   runs a point query per leaf entry
+    def analyze(self, fat_factor=True):
+        nodes_per_depth = collections.Counter()
+        leaves_per_depth = collections.Counter()
+        fan_out = collections.Counter()
+        fill = collections.Counter()
+        radii = collections.defaultdict(list)
+        entries = duplicates = 0
+        pairs = overlapping = 0
+        overlap = 0.0
+        for node, depth in self.walk():
+            nodes_per_depth[depth] += 1
+            fill[10 * (10 * len(node) // self.max_node_size)] += 1
+            if isinstance(node, LeafNode):
+                leaves_per_depth[depth] += 1
+                entries += len(node)
+                duplicates += sum(len(entry.duplicates)
+                                  for entry in node.entries
+                                  if entry.duplicates)
+                continue
+            fan_out[len(node)] += 1
+            siblings = list(node.entries)
+            for i, entry in enumerate(siblings):
+                radii[depth + 1].append(entry.radius)
+                distances = node.distances_to(entry.obj)[1]
+                for other, distance in zip(siblings[i + 1:],
+                                           distances[i + 1:]):
+                    pairs += 1
+                    reach = entry.radius + other.radius
+                    if distance < reach:
+                        overlapping += 1
+                        overlap += (reach - distance) / reach
+
+        def histogram(counter):
+            return collections.OrderedDict(sorted(counter.items()))
+
+        return collections.OrderedDict([
+            ('objects', self.size),
+            ('entries', entries),
+            ('duplicates', duplicates),
+            ('max_node_size', self.max_node_size),
+            ('nodes', sum(nodes_per_depth.values())),
+            ('leaves', sum(leaves_per_depth.values())),
+            ('height', max(nodes_per_depth) + 1),
+            ('depth', collections.OrderedDict([
+                ('nodes', histogram(nodes_per_depth)),
+                ('leaves', histogram(leaves_per_depth))])),
+            ('fan_out', histogram(fan_out)),
+            ('fill', histogram(fill)),
+            ('radii', collections.OrderedDict(
+                (depth, _distribution(values))
+                for depth, values in sorted(radii.items()))),
+            ('overlap', collections.OrderedDict([
+                ('sibling_pairs', pairs),
+                ('overlapping', overlapping),
+                ('ratio', overlapping / float(pairs) if pairs else 0.0),
+                ('mean_overlap',
+                 overlap / overlapping if overlapping else 0.0)])),
+            ('fat_factor', self.fat_factor() if fat_factor else None)])
+
+    #the internal nodes whose children are leaves
+    def _leaf_parents(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, LeafNode):
+                continue
+            if isinstance(node.entries[0].subtree, LeafNode):
+                yield node
+            else:
+                stack.extend(entry.subtree for entry in node.entries)
+
+    #The tree as a FlatMTree: a read-only copy of its current state in a
+    #flat arena
+    def freeze(self):
+        objects, node_leaf, node_first, node_count, entry_object, \
+            entry_distance, entry_radius, entry_child, duplicate_offset, \
+            duplicate_object = self._flatten()
+        nan = float('nan')
+        vectors = None
+        if self.vectorized and objects:
+            vectors = _stack(objects, self.dtype)
+        return FlatMTree(self.d, objects, node_leaf, node_first, node_count,
+                         entry_object,
+                         [nan if x is None else x for x in entry_distance],
+                         [nan if x is None else x for x in entry_radius],
+                         entry_child, len(self), vectors,
+                         duplicate_offset if duplicate_object else None,
+                         duplicate_object, None, self._duplicate_slack())
+
+
+#The header of a snapshot and a function returning a section: the arrays are
+#memory-mapped, the byte strings read
+def _read_snapshot(path):
+    if np is None: # pragma: no cover
+        raise ImportError('snapshots require numpy')
+    with open(path, 'rb') as f:
+        preamble = f.read(_SNAPSHOT_PREAMBLE.size)
+        if len(preamble) < _SNAPSHOT_PREAMBLE.size:
+            raise ValueError('%s is not an MTree snapshot' % path)
+        magic, version, header_size = _SNAPSHOT_PREAMBLE.unpack(preamble)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError('%s is not an MTree snapshot' % path)
+        if version not in _SNAPSHOT_READABLE:
+            raise ValueError('unsupported MTree snapshot version %d' %
+                             version)
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    start = _align(_SNAPSHOT_PREAMBLE.size + header_size)
+    buffer = np.memmap(path, 'uint8', 'r')
+
+    def section(name):
+        spec = header['sections'][name]
+        begin = start + spec['offset']
+        if spec['dtype'] == 'bytes':
+            return bytes(buffer[begin:begin + spec['shape'][0]])
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        return buffer[begin:begin + count * dtype.itemsize] \
+            .view(dtype).reshape(spec['shape'])
+    return header, section
+
+def _snapshot_objects(header, section):
+    if 'vectors' in header['sections']:
+        vectors = section('vectors')
+        return [Row(vectors, i, row_id) for i, row_id in
+                enumerate(pickle.loads(section('ids')))]
+    return pickle.loads(section('objects'))
+
+#The objects of a vectorized snapshot as a read-only sequence: the Row of an
+#object is made when it is asked for, the ids are unpickled on first use
+class _SnapshotRows(object):
+    __slots__ = ('vectors', 'pickled_ids', 'ids')
+
+    def __init__(self, vectors, pickled_ids):
+        self.vectors = vectors
+        self.pickled_ids = pickled_ids
+        self.ids = None
 
-        #at the end will contain the results 
-        nn = NN(k)
+    def __len__(self):
+        return len(self.vectors)
+
+    def __getitem__(self, index):
+        if self.ids is None:
+            self.ids = pickle.loads(self.pickled_ids)
+            self.pickled_ids = None
+        return Row(self.vectors, index, self.ids[index])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+#Read-only M-tree in a flat arena, made by MTree.freeze or loaded from a
+#snapshot. A node is a range of contiguous entries and an entry is an offset
+#into parallel arrays (the number of its object, its distance to the parent
+#routing object, its covering radius and its child node, -1 in the leaves;
+#NaN stands for None), so the traversals follow integer offsets instead of
+#Entry and node objects and the tree costs a few machine words per entry.
+#In vectorized mode the vectors of the entries are the rows of one matrix in
+#entry order: the matrix of a node is a slice of it, nothing is cached per
+#node. The layout is the one of the snapshots, nodes in breadth-first order,
+#the duplicates of entry e (see MTree.collapse_duplicates) are the objects
+#duplicate_object[duplicate_offset[e]:duplicate_offset[e+1]].
+#The queries are those of MTree, without pivots, stats or cache. A modified
+#MTree must be frozen again.
+#load maps the sections of a snapshot without copying them nor building
+#anything per object: the parallel arrays are memoryviews of the file, the
+#matrix of the entries is the entry_vectors section, and the Rows of the
+#objects are made for the results only (version 1 snapshots, without that
+#section, gather the matrix from the vectors in memory). Such a tree cannot
+#be pickled.
+class FlatMTree(object):
+    def __init__(self, d, objects, node_leaf, node_first, node_count,
+                 entry_object, entry_distance, entry_radius, entry_child,
+                 size, vectors=None, duplicate_offset=None,
+                 duplicate_object=None, entry_vectors=None, epsilon=0):
+        self.d = d
+        #an empty tree has no matrix to give to d.batch
+        self.vectorized = vectors is not None and len(objects) > 0 and \
+            callable(getattr(d, 'batch', None))
+        self.objects = objects
+        self.size = size
+        self.node_leaf = _packed('B', node_leaf)
+        self.node_first = _packed('q', node_first)
+        self.node_count = _packed('q', node_count)
+        self.entry_object = _packed('q', entry_object)
+        self.entry_distance = _packed('d', entry_distance)
+        self.entry_radius = _packed('d', entry_radius)
+        self.entry_child = _packed('q', entry_child)
+        self.duplicate_offset = self.duplicate_object = None
+        #the duplicates are within slack of the objects of their entries, as
+        #in MTree._duplicate_slack
+        self.slack = 0
+        if duplicate_offset is not None:
+            self.duplicate_offset = _packed('q', duplicate_offset)
+            self.duplicate_object = _packed('q', duplicate_object)
+            self.slack = epsilon
+        self.entry_vectors = None
+        if self.vectorized:
+            if entry_vectors is None:
+                entry_vectors = np.asarray(vectors)[
+                    np.frombuffer(self.entry_object, 'int64')]
+            self.entry_vectors = np.ascontiguousarray(entry_vectors)
+            #views sharing the memory of the arrays above
+            self._radii = np.frombuffer(self.entry_radius, 'float64')
 
-        while pr:
-            prEntry = heappop(pr)
-            if(prEntry.dmin > nn.search_radius()):
-                #best candidate is too far, we won't have better a answer
-                #we can stop
-                break
-            prEntry.tree.search(query_obj, pr, nn, prEntry.d_query)
+    def __len__(self):
+        return self.size
 
-            #could prune pr here
-            #(the paper prunes after each entry insertion, instead whe could
-            #prune once after handling all the entries of a node)
-            
-        return nn.result_list()
+    def __repr__(self):
+        return 'FlatMTree(%d objects, %d nodes)' % (len(self),
+                                                     len(self.node_leaf))
+
+    @classmethod
+    def load(cls, path, d):
+        header, section = _read_snapshot(path)
+        vectors = section('vectors') \
+            if 'vectors' in header['sections'] else None
+        if vectors is not None:
+            objects = _SnapshotRows(vectors, section('ids'))
+        else:
+            objects = pickle.loads(section('objects'))
+        entry_vectors = section('entry_vectors') \
+            if 'entry_vectors' in header['sections'] else None
+        duplicate_offset = duplicate_object = None
+        if 'duplicate_object' in header['sections']:
+            duplicate_offset = section('duplicate_offset')
+            duplicate_object = section('duplicate_object')
+        return cls(d, objects, section('node_leaf'), section('node_first'),
+                   section('node_count'), section('entry_object'),
+                   section('entry_distance'), section('entry_radius'),
+                   section('entry_child'), header['size'], vectors,
+                   duplicate_offset, duplicate_object, entry_vectors,
+                   header.get('epsilon', 0))
+
+    def memory_footprint(self):
+        #bytes of the arena (the parallel arrays and the matrix of the
+        #entries) and of the indexed objects
+        seen = set()
+        report = collections.OrderedDict()
+        report['nodes'] = sum(_arena_bytes(values) for values in
+                              (self.node_leaf, self.node_first,
+                               self.node_count))
+        report['entries'] = sum(_arena_bytes(values) for values in
+                                (self.entry_object, self.entry_distance,
+                                 self.entry_radius, self.entry_child,
+                                 self.duplicate_offset,
+                                 self.duplicate_object)
+                                if values is not None)
+        if self.entry_vectors is not None:
+            report['entries'] += self.entry_vectors.nbytes
+        report['objects'] = _sizeof(self.objects, seen)
+        report['total'] = sum(report.values())
+        report['objects_count'] = len(self)
+        report['bytes_per_object'] = report['total'] / float(len(self)) \
+            if len(self) else 0.0
+        return report
 
-    def search_in_radius(self, query_obj, distance):
-        if distance == 0: return []
-
-        #priority queue of subtrees not yet explored ordered by dmin
-        pr = []
-        heappush(pr, PrEntry(self.root, 0, 0))
-
-        #at the end will contain the results 
-        nn = NN(len(self))
-        nn.correct_search_radius(distance)
-        while pr:
-            prEntry = heappop(pr)
-            if(prEntry.dmin > nn.search_radius()):
-                #best candidate is too far, we won't have better a answer
-                #we can stop
+    def search(self, query_obj, k=1):
+        #best-first, the subtrees farther than the k-th object found so far
+        #are pruned. found is a max-heap of (-distance, order, obj)
+        entry_child, entry_radius = self.entry_child, self.entry_radius
+        slack = self.slack
+        order = itertools.count()
+        found, radius = [], float('inf')
+        pending = [(0, next(order), 0, 0)]
+        while pending:
+            dmin, _, node, d_parent_query = heappop(pending)
+            if dmin > radius:
                 break
-            prEntry.tree.search(query_obj, pr, nn, prEntry.d_query)
+            for e, d_entry_query in self._matches(node, query_obj,
+                                                  radius + slack,
+                                                  d_parent_query):
+                child = entry_child[e]
+                if child >= 0:
+                    child_dmin = max(d_entry_query - entry_radius[e] - slack,
+                                     0)
+                    if child_dmin <= radius:
+                        heappush(pending, (child_dmin, next(order), child,
+                                           d_entry_query))
+                    continue
+                for obj, distance in self._objects_at(e, d_entry_query,
+                                                      query_obj, k):
+                    item = (-distance, next(order), obj)
+                    if len(found) < k:
+                        heappush(found, item)
+                    elif distance < radius:
+                        heapreplace(found, item)
+                    if len(found) == k:
+                        radius = -found[0][0]
+        return [obj for _, _, obj in sorted(found, reverse=True)]
 
-            #could prune pr here
-            #(the paper prunes after each entry insertion, instead whe could
-            #prune once after handling all the entries of a node)
-            
-        return nn.result_list()
+    def search_in_radius(self, query_obj, distance):
+        return [obj for obj, _ in sorted(self._range(query_obj, distance),
+                                         key=itemgetter(1))]
+
+    def search_in_radius_iter(self, query_obj, distance, sort=False,
+                              limit=None):
+        results = self._ranking(query_obj, distance) if sort \
+            else self._range(query_obj, distance)
+        return islice(results, limit) if limit is not None else results
+
+    def nearest(self, query_obj, max_distance=float('inf')):
+        return self._ranking(query_obj, max_distance)
+
+    #the object of the leaf entry e followed by its duplicates, at most limit
+    #objects if given
+    def _objects_of(self, e, limit=None):
+        obj = self.objects[self.entry_object[e]]
+        if self.duplicate_offset is None:
+            return (obj,)
+        start, end = self.duplicate_offset[e], self.duplicate_offset[e + 1]
+        if limit is not None:
+            end = min(end, start + limit - 1)
+        return [obj] + [self.objects[i]
+                        for i in self.duplicate_object[start:end]]
+
+    #(obj, d(obj, query_obj)) for the objects of the leaf entry e, at
+    #d_entry_query of query_obj: with a slack the distances of the
+    #duplicates are computed, else they are at d_entry_query (and at most
+    #limit objects are given)
+    def _objects_at(self, e, d_entry_query, query_obj, limit=None):
+        if not self.slack:
+            return [(obj, d_entry_query)
+                    for obj in self._objects_of(e, limit)]
+        objs = self._objects_of(e)
+        return [(objs[0], d_entry_query)] + \
+            [(obj, self.d(obj, query_obj)) for obj in objs[1:]]
+
+    #the offsets of the entries of node within search_radius of query_obj
+    #(leaf) or whose ball intersects the query ball, with their distances
+    def _matches(self, node, query_obj, search_radius, d_parent_query):
+        first = self.node_first[node]
+        last = first + self.node_count[node]
+        leaf = self.node_leaf[node]
+        if self.vectorized:
+            distances = self.d.batch(self.entry_vectors[first:last],
+                                     query_obj)
+            if leaf:
+                index = (distances <= search_radius).nonzero()[0]
+            else:
+                index = (distances - self._radii[first:last] -
+                         _ROUNDING_SLACK <= search_radius).nonzero()[0]
+            return zip((index + first).tolist(), distances[index].tolist())
+        d, objects = self.d, self.objects
+        entry_object, entry_distance = self.entry_object, self.entry_distance
+        entry_radius = self.entry_radius
+        result = []
+        for e in range(first, last):
+            radius = 0 if leaf else entry_radius[e]
+            if node and abs(d_parent_query - entry_distance[e]) - \
+                    _ROUNDING_SLACK > search_radius + radius:
+                continue
+            distance = d(objects[entry_object[e]], query_obj)
+            if distance <= search_radius or not leaf and \
+                    distance - radius - _ROUNDING_SLACK <= search_radius:
+                result.append((e, distance))
+        return result
 
-NNEntry = collections.namedtuple('NNEntry', 'obj dmax')
-class NN(object):
-    def __init__(self, size):
-        self.elems = [NNEntry(None, float("inf"))] * size
-        #store dmax in NN as described by the paper
-        #but it would be more logical to store it separately
-        self.dmax = float("inf")
+    def _range(self, query_obj, distance):
+        node_leaf, entry_child = self.node_leaf, self.entry_child
+        stack = [(0, 0)]
+        while stack:
+            node, d_parent_query = stack.pop()
+            matches = self._matches(node, query_obj, distance + self.slack,
+                                    d_parent_query)
+            if node_leaf[node]:
+                for e, d_entry_query in matches:
+                    for obj, d_obj_query in self._objects_at(
+                            e, d_entry_query, query_obj):
+                        if d_obj_query <= distance:
+                            yield obj, d_obj_query
+            else:
+                stack.extend((entry_child[e], d_entry_query)
+                             for e, d_entry_query in matches)
+
+    #best-first traversal as in MTree._ranking, the queue holds (dmin, order,
+    #node, d_parent_query) for the subtrees and (distance, order, -1, object)
+    #for the objects
+    def _ranking(self, query_obj, max_distance=float('inf')):
+        entry_child, entry_radius = self.entry_child, self.entry_radius
+        slack = self.slack
+        order = itertools.count()
+        pending = [(0, next(order), 0, 0)]
+        while pending:
+            dmin, _, node, item = heappop(pending)
+            if node < 0:
+                yield item, dmin
+                continue
+            for e, d_entry_query in self._matches(node, query_obj,
+                                                  max_distance + slack,
+                                                  item):
+                child = entry_child[e]
+                if child < 0:
+                    for obj, distance in self._objects_at(e, d_entry_query,
+                                                          query_obj):
+                        if distance <= max_distance:
+                            heappush(pending, (distance, next(order), -1,
+                                               obj))
+                else:
+                    heappush(pending, (max(d_entry_query - entry_radius[e] -
+                                           slack, 0),
+                                       next(order), child, d_entry_query))
+
+#values (a sequence or a numpy array) as a typed sequence of the given
+#typecode indexed with plain python numbers: an array built from a list, or
+#a memoryview of a numpy array (a memory-mapped section of a snapshot stays
+#mapped, it is not copied)
+def _packed(typecode, values):
+    if np is not None and isinstance(values, np.ndarray):
+        values = np.ascontiguousarray(values, typecode)
+        if len(values):
+            return memoryview(values).cast('B').cast(typecode)
+        values = []
+    packed = array(typecode)
+    packed.extend(values)
+    return packed
+
+def _arena_bytes(values):
+    if isinstance(values, memoryview):
+        return values.nbytes
+    return sys.getsizeof(values)
+
+
+#The entries of node whose ball (or object) can hold objects within radius
+#of the ball (or object) of entry, with their distances to entry.obj.
+#d_parent is d(entry.obj, node.parent_entry.obj) or None if unknown
+def _join_candidates(entry, node, d_parent, radius, record):
+    extent = entry.radius or 0
+    if d_parent is None or node.mtree.vectorized:
+        candidates = zip(*node.distances_to(entry.obj))
+        evaluated = len(node)
+    else:
+        candidates = []
+        for child in node.entries:
+            if abs(d_parent - child.distance_to_parent) - (child.radius or 0) \
+                    - extent - _ROUNDING_SLACK <= radius:
+                candidates.append((child, node.d(child.obj, entry.obj)))
+        evaluated = len(candidates)
+    result = [(child, distance) for child, distance in candidates
+              if _join_match(entry, child, distance, radius)]
+    if record is not None:
+        record.visit(len(node), evaluated, len(result))
+    return result
+
+#The pairs of entries of node (each pair once) whose balls or objects are
+#within radius, with their distances
+def _join_within(node, radius, record):
+    if node.mtree.vectorized and node.entries:
+        entries, block = node._get_block()[:2]
+    else:
+        entries = list(node.entries)
+    root = node.parent_entry is None
+    result = []
+    evaluated = 0
+    for i, entry in enumerate(entries):
+        others = entries[i+1:]
+        if node.mtree.vectorized:
+            distances = node.d.batch(block[i+1:], entry.obj).tolist()
+            evaluated += len(others)
+        else:
+            distances = []
+            for other in others:
+                if not root and abs(entry.distance_to_parent -
+                                    other.distance_to_parent) - \
+                        (entry.radius or 0) - (other.radius or 0) - \
+                        _ROUNDING_SLACK > radius:
+                    distances.append(None)
+                    continue
+                evaluated += 1
+                distances.append(node.d(entry.obj, other.obj))
+        result.extend((entry, other, distance)
+                      for other, distance in zip(others, distances)
+                      if distance is not None and
+                      _join_match(entry, other, distance, radius))
+    if record is not None:
+        pairs = len(entries) * (len(entries) - 1) // 2
+        record.visit(pairs, evaluated, len(result))
+    return result
+
+#the object of a leaf entry followed by its duplicates
+def _entry_objects(entry):
+    if entry.duplicates:
+        return [entry.obj] + entry.duplicates
+    return (entry.obj,)
+
+#True if the objects of two entries at distance from each other are within
+#radius, or if their balls are
+def _join_match(entry1, entry2, distance, radius):
+    if entry1.subtree is None and entry2.subtree is None:
+        return distance <= radius
+    return distance - (entry1.radius or 0) - (entry2.radius or 0) - \
+        _ROUNDING_SLACK <= radius
+
+
+#Size in bytes of obj and of what it references (attributes, items), skipping
+#the objects already in seen. Numpy views count the array they are a view of.
+def _sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, type(None))):
+        return size
+    if np is not None and isinstance(obj, np.ndarray):
+        return size + _sizeof(obj.base, seen) if obj.base is not None \
+            else size
+    if isinstance(obj, dict):
+        return size + sum(_sizeof(key, seen) + _sizeof(value, seen)
+                          for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(_sizeof(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += _sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(obj, name):
+                size += _sizeof(getattr(obj, name), seen)
+    return size
+
+
+#the lower bounds given by the distances to the parent and by the covering
+#radii are differences of rounded distances: without this slack an object
+#exactly at the search radius could be pruned
+_ROUNDING_SLACK = 1e-9
+
+_SNAPSHOT_MAGIC = b'MTREEIDX'
+#version 2 adds the entry_vectors section, version 1 snapshots are still
+#read
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_READABLE = (1, 2)
+_SNAPSHOT_PREAMBLE = struct.Struct('<8sII')
+
+def _align(offset, alignment=64):
+    return -(-offset // alignment) * alignment
+
+
+BuildStats = collections.namedtuple('BuildStats',
+                                    'objects distance_calls seconds')
+
+OptimizeStats = collections.namedtuple('OptimizeStats',
+                                       'moved fat_factor_before '
+                                       'fat_factor_after distance_calls '
+                                       'seconds')
+
+
+#d counting its calls. Wrapping a vectorized metric gives a
+#_CountingVectorMetric, which also counts the rows given to batch: like d,
+#it has a batch method only if d has one
+class _CountingDistance(object):
+    def __new__(cls, d):
+        if cls is _CountingDistance and callable(getattr(d, 'batch', None)):
+            cls = _CountingVectorMetric
+        return object.__new__(cls)
+
+    def __init__(self, d):
+        self.d = d
+        self.calls = 0
 
-    def __len__(self):
-        return len(self.elems)
+    def __call__(self, obj1, obj2):
+        self.calls += 1
+        return self.d(obj1, obj2)
 
-    def search_radius(self):
-        return self.dmax
+class _CountingVectorMetric(_CountingDistance):
+    @property
+    def dtype(self):
+        return self.d.dtype
 
-    def update(self, obj, dmax):
-        if obj == None:
-            #internal node
-            self.dmax = min(self.dmax, dmax)
-            return
-        self.elems.append(NNEntry(obj, dmax))
-        for i in range(len(self)-1, 0, -1):
-            if self.elems[i].dmax < self.elems[i-1].dmax:
-                self.elems[i-1], self.elems[i] = self.elems[i], self.elems[i-1]
-            else:
-                break
-        self.elems.pop()
+    def batch(self, objs, obj):
+        self.calls += len(objs)
+        return self.d.batch(objs, obj)
 
-    def result_list(self):
-        result = map(lambda entry: entry.obj, self.elems)
-        return result
+
+#Counters of the instrumentation of an MTree, see MTree.enable_stats
+class Stats(object):
+    def __init__(self):
+        self.adds = 0
+        self.add_distance_calls = 0
+        #splits include the splits of internal nodes, split_distance_calls
+        #is a part of add_distance_calls
+        self.splits = 0
+        self.split_distance_calls = 0
+        self.queries = []
 
     def __repr__(self):
-        return "NN(%r)" % self.elems
+        return 'Stats(adds=%d, splits=%d, queries=%d)' % (
+            self.adds, self.splits, len(self.queries))
+
+    def reset(self):
+        self.__init__()
+
+    def as_dict(self):
+        totals = collections.OrderedDict((name, 0) for name in
+                                         QueryStats.counters)
+        for record in self.queries:
+            for name in QueryStats.counters:
+                totals[name] += getattr(record, name)
+        totals['peak_queue'] = max([record.peak_queue
+                                    for record in self.queries] or [0])
+        return collections.OrderedDict([
+            ('adds', self.adds),
+            ('add_distance_calls', self.add_distance_calls),
+            ('splits', self.splits),
+            ('split_distance_calls', self.split_distance_calls),
+            ('query_count', len(self.queries)),
+            ('query_totals', totals),
+            ('queries', [record.as_dict() for record in self.queries])])
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+#What one query cost: the distances computed (including the distances to the
+#pivots), the nodes whose entries were examined, the entries discarded
+#without computing their distance (by the lemma of the distance to the parent
+#or by the pivots) and after it (radius, including the subtrees left in the
+#queue by the dmin cutoff of search) and the largest size of the queue of
+#pending subtrees
+class QueryStats(object):
+    __slots__ = ('kind', 'distance_calls', 'nodes_visited', 'lemma_pruned',
+                 'pivot_pruned', 'radius_pruned', 'peak_queue')
+    counters = ('distance_calls', 'nodes_visited', 'lemma_pruned',
+                'pivot_pruned', 'radius_pruned')
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.distance_calls = 0
+        self.nodes_visited = 0
+        self.lemma_pruned = 0
+        self.pivot_pruned = 0
+        self.radius_pruned = 0
+        self.peak_queue = 0
 
-    def correct_search_radius(self, dmax):
-        self.fixed_radius = True
-        self.dmax = dmax
+    def __repr__(self):
+        return 'QueryStats(%s)' % ', '.join(
+            '%s=%r' % item for item in self.as_dict().items())
+
+    def visit(self, entries, evaluated, matched, pivot_pruned=0):
+        self.nodes_visited += 1
+        self.distance_calls += evaluated
+        self.lemma_pruned += entries - evaluated - pivot_pruned
+        self.pivot_pruned += pivot_pruned
+        self.radius_pruned += evaluated - matched
+
+    def as_dict(self):
+        return collections.OrderedDict((name, getattr(self, name))
+                                       for name in self.__slots__)
+
+
+#LRU cache of query results, bounded by max_entries and (if given) by
+#max_bytes, an estimate of the memory of the keys and result lists (the
+#objects themselves belong to the tree).
+#The key of a query is key(query_obj) plus the query parameters. The default
+#key normalizes vectors (Rows, arrays, sequences of numbers) to a tuple of
+#floats so equal vectors share an entry whatever their type, and uses other
+#objects hashed by value as they are. Queries whose key is None are not
+#cached.
+#Each entry keeps its query and its radius of influence (the radius of a
+#range query, the distance of the k-th neighbour): adding or removing an
+#object evicts the entries whose query is within that radius of it, which
+#costs one distance per cached entry.
+class QueryCache(object):
+    def __init__(self, max_entries=1024, max_bytes=None, key=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.key_function = key or _query_key
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.evictions = self.invalidations = 0
 
-    def search_radius(self):
-        return self.dmax
-            
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return 'QueryCache(%d entries, %d hits, %d misses)' % (
+            len(self), self.hits, self.misses)
+
+    def key(self, query_obj, *parameters):
+        key = self.key_function(query_obj)
+        return None if key is None else (key,) + parameters
+
+    def get(self, key):
+        cached = self.entries.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return cached[2]
+
+    def put(self, key, query_obj, influence, result):
+        size = sys.getsizeof(key) + sys.getsizeof(result)
+        if isinstance(key[0], tuple):
+            size += sum(sys.getsizeof(part) for part in key[0])
+        if key in self.entries:
+            self._discard(key)
+        self.entries[key] = (query_obj, influence, result, size)
+        self.bytes += size
+        while self.entries and (
+                len(self.entries) > self.max_entries or
+                self.max_bytes is not None and self.bytes > self.max_bytes):
+            self._discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, obj, d):
+        stale = [key for key, (query_obj, influence, _, _) in
+                 self.entries.items() if d(query_obj, obj) <= influence]
+        for key in stale:
+            self._discard(key)
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.bytes = 0
+
+    def _discard(self, key):
+        self.bytes -= self.entries.pop(key)[3]
+
+    def info(self):
+        return collections.OrderedDict([
+            ('entries', len(self.entries)),
+            ('bytes', self.bytes),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('evictions', self.evictions),
+            ('invalidations', self.invalidations)])
+
+
+def _query_key(query_obj):
+    if isinstance(query_obj, Row):
+        query_obj = query_obj.vector
+    if np is not None and isinstance(query_obj, np.ndarray):
+        return tuple(query_obj.astype('float64').ravel().tolist())
+    if isinstance(query_obj, (tuple, list)) and \
+            all(isinstance(x, (int, float)) for x in query_obj):
+        return tuple(float(x) for x in query_obj)
+    #objects hashed by identity may be modified between two queries
+    if type(query_obj).__hash__ in (None, object.__hash__):
+        return None
+    return query_obj
+
+
+ApproximateResult = collections.namedtuple('ApproximateResult',
+                                           'objects exact')
+
+
+#Budget of an approximate search: max_distance_calls distance computations
+#(as counted by the QueryStats of the search) and max_ms milliseconds
+class _Budget(object):
+    def __init__(self, max_distance_calls=None, max_ms=None):
+        self.max_distance_calls = max_distance_calls
+        self.deadline = None if max_ms is None \
+            else time.perf_counter() + max_ms / 1000.0
+        self.stopped = False
+
+    def exhausted(self, record):
+        if self.max_distance_calls is not None and \
+                record.distance_calls >= self.max_distance_calls:
+            return True
+        return self.deadline is not None and \
+            time.perf_counter() >= self.deadline
+
+
+QueryResult = collections.namedtuple('QueryResult',
+                                     'objects distance_calls seconds')
+
+
+#(tree, {id(obj): object number}) in the processes of search_many
+_worker_state = None
+
+def _init_query_worker(path, d, promote, partition):
+    global _worker_state
+    tree, objects = MTree._load(path, d, promote, partition)
+    _worker_state = (tree, dict((id(obj), i)
+                                for i, obj in enumerate(objects)))
+
+
+def _query_worker(task):
+    tree, numbers = _worker_state
+    method, args, query = task
+    result = _run_query(tree, method, args, query)
+    return ([numbers[id(obj)] for obj in result.objects],
+            result.distance_calls, result.seconds)
+
+
+def _run_query(tree, method, args, query):
+    d = tree.d
+    tree.d = counter = _CountingDistance(d)
+    start = time.perf_counter()
+    try:
+        objects = list(getattr(tree, method)(query, *args))
+    finally:
+        tree.d = d
+    return QueryResult(objects, counter.calls, time.perf_counter() - start)
 
-class PrEntry(object):
-    def __init__(self, tree, dmin, d_query):
-        self.tree = tree
-        self.dmin = dmin
-        self.d_query = d_query
 
-    def __lt__(self, other):
-        return self.dmin < other.dmin
+#a Row pickles the whole matrix it is a row of, send only its vector
+def _plain_query(query):
+    if isinstance(query, Row):
+        return np.array(query.vector)
+    return query
+
+
+#size of the queue of pending subtrees of a k-NN search from which it is
+#pruned, see MTree._knn
+_KNN_PRUNE_SIZE = 64
+
+#The k nearest objects found so far: a bounded max-heap of
+#(-distance, order, obj) whose root, the k-th nearest object, is replaced by
+#any nearer one. radius is its distance (infinite until k objects are
+#found). order decreases, so that among objects at the same distance the
+#first found are kept; it also breaks the ties of the queue of pending
+#subtrees of the search. slack (see MTree._duplicate_slack) widens the
+#search radius and the balls of the subtrees.
+class NN(object):
+    __slots__ = ('size', 'heap', 'radius', 'order', 'slack')
+
+    def __init__(self, size, slack=0):
+        self.size = size
+        self.heap = []
+        self.radius = float('inf')
+        self.order = itertools.count(0, -1)
+        self.slack = slack
+
+    def __len__(self):
+        return self.size
 
     def __repr__(self):
-        return "PrEntry(tree:%r, dmin:%r)" % (self.tree, self.dmin)
+        return 'NN(%r)' % [(obj, -distance) for distance, _, obj
+                           in sorted(self.heap, reverse=True)]
+
+    def search_radius(self):
+        return self.radius + self.slack
+
+    def update(self, obj, distance):
+        if len(self.heap) < self.size:
+            heappush(self.heap, (-distance, next(self.order), obj))
+            if len(self.heap) == self.size:
+                self.radius = -self.heap[0][0]
+        elif distance < self.radius:
+            heapreplace(self.heap, (-distance, next(self.order), obj))
+            self.radius = -self.heap[0][0]
+
+    def result_list(self):
+        #nearest first
+        return [obj for _, _, obj in sorted(self.heap, reverse=True)]
 
     
 class Entry(object):
+    #pivot_distances: array of the distances from obj to the pivots of the
+    #tree (see MTree.select_pivots), shared by the entries of the same obj.
+    #duplicates: list of the objects collapsed into a leaf entry (see
+    #MTree.collapse_duplicates), None if there is none
+    __slots__ = ('obj', 'distance_to_parent', 'radius', 'subtree',
+                 'pivot_distances', 'duplicates')
+
     def __init__(self,
                  obj,
                  distance_to_parent=None,
                  radius=None,
-                 subtree=None):
+                 subtree=None,
+                 pivot_distances=None,
+                 duplicates=None):
         self.obj = obj
         self.distance_to_parent = distance_to_parent
         self.radius = radius
         self.subtree = subtree
+        self.pivot_distances = pivot_distances
+        self.duplicates = duplicates
 
     def __repr__(self):
         return "Entry(obj: %r, dist: %r, radius: %r, subtree: %r)" % (
@@ -199,6 +2205,7 @@ class Entry(object):
 
 class AbstractNode(object):
     __metaclass__ = abc.ABCMeta
+    __slots__ = ('mtree', 'parent_node', 'parent_entry', 'entries', '_block')
 
     def __init__(self,
                  mtree,
@@ -208,7 +2215,10 @@ class AbstractNode(object):
         self.mtree = mtree
         self.parent_node = parent_node
         self.parent_entry = parent_entry
-        self.entries = set(entries) if entries else set()
+        #a list, so that the traversals (and the builds) follow a
+        #reproducible order
+        self.entries = list(entries) if entries else []
+        self._block = None
 
     def __repr__(self): # pragma: no cover
         entries_str = '%s' % list(islice(self.entries, 2))
@@ -245,27 +2255,112 @@ class AbstractNode(object):
 
     def remove_entry(self, entry):
         self.entries.remove(entry)
+        self._block = None
 
     def add_entry(self, entry):
         if self.is_full():
             raise ValueError('Trying to add %s into a full node' % str(entry))
-        self.entries.add(entry)
-
-    #TODO recomputes d(leaf, parent)!
-    def set_entries_and_parent_entry(self, new_entries, new_parent_entry):
-        self.entries = new_entries
+        self.entries.append(entry)
+        self._block = None
+
+    #sets the distances to the parent and the covering radius of the new
+    #parent entry with a single distance per entry. d, if given, is used
+    #instead of self.d (split passes the distances it already knows)
+    def set_entries_and_parent_entry(self, new_entries, new_parent_entry,
+                                     d=None):
+        self.entries = list(new_entries)
+        self._block = None
         self.parent_entry = new_parent_entry
-        self.parent_entry.radius = self.covering_radius_for(self.parent_entry.obj)
-        self._update_entries_distance_to_parent()
-
-    def _update_entries_distance_to_parent(self):
-        if self.parent_entry:
-            for entry in self.entries:
-                entry.distance_to_parent = self.d(entry.obj,
-                                                  self.parent_entry.obj)
-
+        if d is None:
+            entries, distances = self.distances_to(new_parent_entry.obj)
+        else:
+            entries = list(self.entries)
+            distances = [d(entry.obj, new_parent_entry.obj)
+                         for entry in entries]
+        radius = 0
+        for entry, distance in zip(entries, distances):
+            entry.distance_to_parent = distance
+            if entry.subtree is not None:
+                distance += entry.radius
+            radius = max(radius, distance)
+        new_parent_entry.radius = radius
+
+    def _get_block(self):
+        #the entries of the node in a fixed order, their objects as the rows
+        #of a matrix, their radii as an array and their distances to the
+        #pivots as a matrix.
+        #Must be reset (self._block = None) whenever one of them changes
+        if self._block is None:
+            entries = list(self.entries)
+            block = _stack([entry.obj for entry in entries],
+                           self.mtree.dtype)
+            radii = pivots = None
+            if isinstance(self, InternalNode):
+                radii = np.array([entry.radius for entry in entries],
+                                 'float64')
+            if self.mtree.pivots is not None:
+                pivots = np.array([entry.pivot_distances
+                                   for entry in entries], 'float64')
+            self._block = (entries, block, radii, pivots)
+        return self._block
+
+    def distances_to(self, obj):
+        #returns the entries of the node and their distances to obj. In
+        #vectorized mode the distances are computed with a single call on the
+        #matrix of the objects of the node
+        if not self.mtree.vectorized or not self.entries:
+            entries = list(self.entries)
+            return entries, [self.d(entry.obj, obj) for entry in entries]
+        entries, block = self._get_block()[:2]
+        return entries, self.d.batch(block, obj).tolist()
+
+    def vector_search(self, query_obj, search_radius, query_pivots=None):
+        #vectorized version of the filtering done by search: returns the
+        #entries that could be (leaf) or contain (internal node) objects
+        #within search_radius of query_obj, their distances to it and the
+        #number of distances computed.
+        #Computing all the distances of the node with one call is cheaper
+        #than filtering them first with the distances to the parent, only
+        #the rows that the pivots cannot exclude are given to d
+        if not self.entries:
+            return [], [], 0
+        entries, block, radii, pivots = self._get_block()
+        if query_pivots is None or pivots is None:
+            candidates = None
+        else:
+            bounds = np.abs(pivots - query_pivots).max(axis=1)
+            if radii is not None:
+                bounds -= radii
+            candidates = (bounds - _ROUNDING_SLACK <= search_radius) \
+                .nonzero()[0]
+            block = block[candidates]
+            if radii is not None:
+                radii = radii[candidates]
+        distances = self.d.batch(block, query_obj)
+        lower_bounds = distances if radii is None \
+            else distances - radii - _ROUNDING_SLACK
+        index = (lower_bounds <= search_radius).nonzero()[0]
+        evaluated = len(distances)
+        distances = distances[index].tolist()
+        if candidates is not None:
+            index = candidates[index]
+        return [entries[i] for i in index], distances, evaluated
+
+    def pivots_exclude(self, entry, query_pivots, search_radius):
+        #True if the distances to the pivots prove that entry (the ball of
+        #entry for an internal node) is farther than search_radius
+        if query_pivots is None:
+            return False
+        bound = max(abs(query_distance - distance) for query_distance, distance
+                    in zip(query_pivots, entry.pivot_distances))
+        if entry.subtree is not None:
+            bound -= entry.radius
+        return bound - _ROUNDING_SLACK > search_radius
+
+    #d_parent is d(obj, self.parent_entry.obj) when the caller knows it.
+    #Returns the new leaf entry
     @abc.abstractmethod
-    def add(self, obj): # pragma: no cover
+    def add(self, obj, d_parent=None): # pragma: no cover
         pass
 
     @abc.abstractmethod         
@@ -273,11 +2368,14 @@ class AbstractNode(object):
         pass
 
     @abc.abstractmethod
-    def search(self, query_obj, pr, nn, d_parent_query):
+    def search(self, query_obj, pr, nn, d_parent_query, record=None,
+               query_pivots=None):
         pass
         
 
 class LeafNode(AbstractNode):
+    __slots__ = ()
+
     def __init__(self,
                  mtree,
                  parent_node=None,
@@ -289,21 +2387,33 @@ class LeafNode(AbstractNode):
                               parent_node,
                               parent_entry,
                               entries)
-    def add(self, obj):
-        distance_to_parent = self.d(obj, self.parent_entry.obj) \
-            if self.parent_entry else None
+    def add(self, obj, d_parent=None):
+        if self.parent_entry is None:
+            distance_to_parent = None
+        elif d_parent is not None:
+            distance_to_parent = d_parent
+        else:
+            distance_to_parent = self.d(obj, self.parent_entry.obj)
         new_entry = Entry(obj, distance_to_parent)
+        if self.mtree.pivots is not None:
+            new_entry.pivot_distances = self.mtree._pivot_distances_for(obj)
         if not self.is_full():
-            self.entries.add(new_entry)
+            self.add_entry(new_entry)
+        elif self.mtree.stats is None:
+            split(self, new_entry, self.d)
         else:
+            #self.d counts the distances during an instrumented add
+            calls = self.d.calls
             split(self, new_entry, self.d)
+            self.mtree.stats.split_distance_calls += self.d.calls - calls
         assert self.is_root() or self.parent_node        
+        return new_entry
 
     def covering_radius_for(self, obj):
         if not self.entries:
             return 0
         else:
-            return max(map(lambda e: self.d(obj, e.obj), self.entries))
+            return max(self.distances_to(obj)[1])
 
     def could_contain_results(self,
                               query_obj,
@@ -313,20 +2423,90 @@ class LeafNode(AbstractNode):
         if self.is_root():
             return True
         
-        return abs(d_parent_query - distance_to_parent)\
+        return abs(d_parent_query - distance_to_parent) - _ROUNDING_SLACK\
                 <= search_radius
-        
-    def search(self, query_obj, pr, nn, d_parent_query):
+
+    def matches(self, query_obj, search_radius, d_parent_query,
+                record=None, query_pivots=None):
+        #the entries within search_radius of query_obj and their distances
+        if self.mtree.vectorized:
+            entries, distances, evaluated = self.vector_search(
+                query_obj, search_radius, query_pivots)
+            if record is not None:
+                record.visit(len(self.entries), evaluated, len(entries),
+                             len(self.entries) - evaluated)
+            return zip(entries, distances)
+        result = []
+        evaluated = pivot_pruned = 0
         for entry in self.entries:
             if self.could_contain_results(query_obj,
-                                          nn.search_radius(),
+                                          search_radius,
                                           entry.distance_to_parent,
                                           d_parent_query):
+                if self.pivots_exclude(entry, query_pivots, search_radius):
+                    pivot_pruned += 1
+                    continue
+                evaluated += 1
+                distance_entry_to_q = self.d(entry.obj, query_obj)
+                if distance_entry_to_q <= search_radius:
+                    result.append((entry, distance_entry_to_q))
+        if record is not None:
+            record.visit(len(self.entries), evaluated, len(result),
+                         pivot_pruned)
+        return result
+        
+    def search(self, query_obj, pr, nn, d_parent_query, record=None,
+               query_pivots=None):
+        evaluated = matched = pivot_pruned = 0
+        if self.mtree.vectorized:
+            entries, distances, evaluated = self.vector_search(
+                query_obj, nn.search_radius(), query_pivots)
+            pivot_pruned = len(self.entries) - evaluated
+            for entry, distance_entry_to_q in zip(entries, distances):
+                if distance_entry_to_q <= nn.search_radius():
+                    matched += 1
+                    evaluated += self._found(entry, distance_entry_to_q, nn,
+                                             query_obj)
+        else:
+            for entry in self.entries:
+                if not self.could_contain_results(query_obj,
+                                                  nn.search_radius(),
+                                                  entry.distance_to_parent,
+                                                  d_parent_query):
+                    continue
+                if self.pivots_exclude(entry, query_pivots,
+                                       nn.search_radius()):
+                    pivot_pruned += 1
+                    continue
+                evaluated += 1
                 distance_entry_to_q = self.d(entry.obj, query_obj)
                 if distance_entry_to_q <= nn.search_radius():
-                    nn.update(entry.obj, distance_entry_to_q)
+                    matched += 1
+                    evaluated += self._found(entry, distance_entry_to_q, nn,
+                                             query_obj)
+        if record is not None:
+            record.visit(len(self.entries), evaluated, matched, pivot_pruned)
+
+    #gives the objects of entry to nn, returns the number of distances
+    #computed (those of the duplicates with a slack)
+    def _found(self, entry, distance, nn, query_obj):
+        nn.update(entry.obj, distance)
+        if not entry.duplicates:
+            return 0
+        if nn.slack:
+            for dup in entry.duplicates:
+                nn.update(dup, self.d(dup, query_obj))
+            return len(entry.duplicates)
+        #at most len(nn) objects of the entry can be among the results
+        for dup in islice(entry.duplicates, len(nn) - 1):
+            if distance >= nn.radius:
+                break
+            nn.update(dup, distance)
+        return 0
     
 class InternalNode(AbstractNode):
+    __slots__ = ()
+
     def __init__(self,
                  mtree,
                  parent_node=None,
@@ -339,42 +2519,78 @@ class InternalNode(AbstractNode):
                               parent_entry,
                               entries)
 
-    #TODO: apply optimization that uses the d of the parent to reduce the
-    #number of d computation performed. cf M-Tree paper 3.3
-    def add(self, obj):     
-        dist_to_obj = {}
-        for entry in self.entries:
-            dist_to_obj[entry] = self.d(obj, entry.obj)
-
-        def find_best_entry_requiring_no_covering_radius_increase():
-            valid_entries = [e for e in self.entries
-                             if dist_to_obj[e] <= e.radius]
-            return min(valid_entries, key=dist_to_obj.get) \
-                if valid_entries else None
-                
-        def find_best_entry_minimizing_radius_increase():
-            entry = min(self.entries,
-                             key=lambda e: dist_to_obj[e] - e.radius)
-            #enlarge radius so that obj is in the covering radius of e 
-            entry.radius = dist_to_obj[entry]
-            return entry
-
-        entry = find_best_entry_requiring_no_covering_radius_increase() or \
-            find_best_entry_minimizing_radius_increase()
-        entry.subtree.add(obj)
+    def add(self, obj, d_parent=None):
+        entry, distance = self.choose_subtree(obj, d_parent)
+        if distance > entry.radius:
+            #enlarge radius so that obj is in the covering radius of entry
+            entry.radius = distance
+            self._block = None
+        #the distance to the chosen routing object is the distance to the
+        #parent of the subtree, it is not computed again
+        new_entry = entry.subtree.add(obj, distance)
         assert self.is_root() or self.parent_node
+        return new_entry
+
+    #The entry whose subtree obj goes in and d(obj, entry.obj): the nearest
+    #entry whose covering radius already contains obj or, if there is none,
+    #the one whose radius grows the least.
+    #Knowing d_parent, |d_parent - entry.distance_to_parent| is a lower bound
+    #of d(obj, entry.obj) (M-Tree paper 3.3): the entries are examined in
+    #increasing bound order and d is only computed while the bound can still
+    #beat the best entry found. In vectorized mode one batch call is cheaper.
+    def choose_subtree(self, obj, d_parent=None):
+        if d_parent is None or self.parent_entry is None or \
+                self.mtree.vectorized:
+            entries, distances = self.distances_to(obj)
+            covering = [(distance, entry) for entry, distance in
+                        zip(entries, distances) if distance <= entry.radius]
+            if covering:
+                distance, entry = min(covering, key=itemgetter(0))
+                return entry, distance
+            return min(zip(entries, distances),
+                       key=lambda pair: pair[1] - pair[0].radius)
+
+        bounds = [(abs(d_parent - entry.distance_to_parent), entry)
+                  for entry in self.entries]
+        distances = {}
+        best, best_distance = None, float('inf')
+        for bound, entry in sorted(bounds, key=itemgetter(0)):
+            if bound >= best_distance:
+                break
+            if bound <= entry.radius:
+                distance = distances[entry] = self.d(obj, entry.obj)
+                if distance <= entry.radius and distance < best_distance:
+                    best, best_distance = entry, distance
+        if best is not None:
+            return best, best_distance
+
+        best_increase = float('inf')
+        for bound, entry in sorted(bounds,
+                                   key=lambda pair: pair[0] - pair[1].radius):
+            if bound - entry.radius >= best_increase:
+                break
+            distance = distances.get(entry)
+            if distance is None:
+                distance = self.d(obj, entry.obj)
+            if distance - entry.radius < best_increase:
+                best, best_distance = entry, distance
+                best_increase = distance - entry.radius
+        return best, best_distance
 
     def covering_radius_for(self, obj):
         if not self.entries:
             return 0
         else:
-            return max(map(lambda e: self.d(obj, e.obj) + e.radius,
-                           self.entries))
+            entries, distances = self.distances_to(obj)
+            return max(distance + entry.radius
+                       for entry, distance in zip(entries, distances))
 
-    def set_entries_and_parent_entry(self, new_entries, new_parent_entry):
+    def set_entries_and_parent_entry(self, new_entries, new_parent_entry,
+                                     d=None):
         AbstractNode.set_entries_and_parent_entry(self,
                                                   new_entries,
-                                                  new_parent_entry)
+                                                  new_parent_entry,
+                                                  d)
         for entry in self.entries:
             entry.subtree.parent_node = self
 
@@ -387,57 +2603,139 @@ class InternalNode(AbstractNode):
             return True
         
         parent_obj = self.parent_entry.obj
-        return abs(d_parent_query - entry.distance_to_parent)\
+        return abs(d_parent_query - entry.distance_to_parent) - _ROUNDING_SLACK\
                 <= search_radius + entry.radius
-            
-    def search(self, query_obj, pr, nn, d_parent_query):
+
+    def matches(self, query_obj, search_radius, d_parent_query,
+                record=None, query_pivots=None):
+        #the entries whose covering ball intersects the query ball and their
+        #distances to query_obj
+        if self.mtree.vectorized:
+            entries, distances, evaluated = self.vector_search(
+                query_obj, search_radius, query_pivots)
+            if record is not None:
+                record.visit(len(self.entries), evaluated, len(entries),
+                             len(self.entries) - evaluated)
+            return zip(entries, distances)
+        result = []
+        evaluated = pivot_pruned = 0
         for entry in self.entries:
             if self.could_contain_results(query_obj,
-                                          nn.search_radius(),
+                                          search_radius,
                                           entry,
                                           d_parent_query):
+                if self.pivots_exclude(entry, query_pivots, search_radius):
+                    pivot_pruned += 1
+                    continue
+                evaluated += 1
                 d_entry_query = self.d(entry.obj, query_obj)
-                entry_dmin = max(d_entry_query - \
-                                     entry.radius, 0)
-                if entry_dmin <= nn.search_radius():
-                    heappush(pr, PrEntry(entry.subtree, entry_dmin, d_entry_query))
-                    entry_dmax = d_entry_query + entry.radius
-                    if entry_dmax < nn.search_radius():
-                        nn.update(None, entry_dmax)
+                if d_entry_query - entry.radius - _ROUNDING_SLACK \
+                        <= search_radius:
+                    result.append((entry, d_entry_query))
+        if record is not None:
+            record.visit(len(self.entries), evaluated, len(result),
+                         pivot_pruned)
+        return result
+            
+    def search(self, query_obj, pr, nn, d_parent_query, record=None,
+               query_pivots=None):
+        evaluated = matched = pivot_pruned = 0
+        if self.mtree.vectorized:
+            entries, distances, evaluated = self.vector_search(
+                query_obj, nn.search_radius(), query_pivots)
+            pivot_pruned = len(self.entries) - evaluated
+            for entry, d_entry_query in zip(entries, distances):
+                matched += self._push(entry, d_entry_query, pr, nn)
+        else:
+            for entry in self.entries:
+                if not self.could_contain_results(query_obj,
+                                                  nn.search_radius(),
+                                                  entry,
+                                                  d_parent_query):
+                    continue
+                if self.pivots_exclude(entry, query_pivots,
+                                       nn.search_radius()):
+                    pivot_pruned += 1
+                    continue
+                evaluated += 1
+                matched += self._push(entry, self.d(entry.obj, query_obj),
+                                      pr, nn)
+        if record is not None:
+            record.visit(len(self.entries), evaluated, matched, pivot_pruned)
+
+    #queues the subtree of entry if it can contain a result, returns True if
+    #it does
+    def _push(self, entry, d_entry_query, pr, nn):
+        entry_dmin = max(d_entry_query - \
+                             entry.radius - nn.slack, 0)
+        if entry_dmin > nn.radius:
+            return False
+        heappush(pr, (entry_dmin, next(nn.order), entry.subtree,
+                      d_entry_query))
+        return True
                         
 
 #TODO: Ugly, complex code. Move some code in Node/Entry?
 def split(existing_node, entry, d):
     assert existing_node.is_full()
     mtree = existing_node.mtree
+    if mtree.stats is not None:
+        mtree.stats.splits += 1
 
     new_node = type(existing_node)(existing_node.mtree)
-    all_entries = existing_node.entries | set((entry,))
+    all_entries = existing_node.entries + [entry]
+    old_existing_node_parent_entry = existing_node.parent_entry
 
-    routing_object1, routing_object2 = \
-        mtree.promote(all_entries, existing_node.parent_entry, d)
+    #promote, partition, the radii and the distances to the parents share
+    #the distances computed during the split, starting with the ones stored
+    #in the entries: with M_LB_DIST_confirmed the distances to the first
+    #routing object are all known
+    split_d = _SplitDistances(d)
+    if old_existing_node_parent_entry is not None:
+        for e in all_entries:
+            if e.distance_to_parent is not None:
+                split_d.known(e.obj, old_existing_node_parent_entry.obj,
+                              e.distance_to_parent)
+        if old_existing_node_parent_entry.distance_to_parent is not None:
+            split_d.known(old_existing_node_parent_entry.obj,
+                          existing_node.parent_node.parent_entry.obj,
+                          old_existing_node_parent_entry.distance_to_parent)
+
+    if mtree._promote_rng:
+        routing_object1, routing_object2 = mtree.promote(
+            all_entries, existing_node.parent_entry, split_d, rng=mtree.rng)
+    else:
+        routing_object1, routing_object2 = \
+            mtree.promote(all_entries, existing_node.parent_entry, split_d)
     entries1, entries2 = mtree.partition(all_entries,
                                          routing_object1,
                                          routing_object2,
-                                         d)
+                                         split_d)
     assert entries1 and entries2, "Error during split operation. All the entries have been assigned to one routing_objects and none to the other! Should never happen since at least the routing objects are assigned to their corresponding set of entries"
 
-    old_existing_node_parent_entry = existing_node.parent_entry
-
     #TODO: build_entry in the node method?
     existing_node_entry = Entry(routing_object1,
                                 None,#distance_to_parent set later
                                 None,#covering_radius set later
                                 existing_node)    
     existing_node.set_entries_and_parent_entry(entries1,
-                                               existing_node_entry)
+                                               existing_node_entry,
+                                               split_d)
 
     new_node_entry = Entry(routing_object2, 
                            None,
                            None,
                            new_node)
     new_node.set_entries_and_parent_entry(entries2,
-                                          new_node_entry)
+                                          new_node_entry,
+                                          split_d)
+    if mtree.pivots is not None:
+        known = list(all_entries)
+        if old_existing_node_parent_entry is not None:
+            known.append(old_existing_node_parent_entry)
+        for routing_entry in (existing_node_entry, new_node_entry):
+            routing_entry.pivot_distances = \
+                mtree._pivot_distances_for(routing_entry.obj, known)
                                           
     if existing_node.is_root():
         new_root_node = InternalNode(existing_node.mtree)
@@ -454,9 +2752,9 @@ def split(existing_node, entry, d):
 
         if not parent_node.is_root():
             existing_node_entry.distance_to_parent = \
-                d(existing_node_entry.obj, parent_node.parent_entry.obj)
+                split_d(existing_node_entry.obj, parent_node.parent_entry.obj)
             new_node_entry.distance_to_parent = \
-                d(new_node_entry.obj, parent_node.parent_entry.obj)
+                split_d(new_node_entry.obj, parent_node.parent_entry.obj)
 
         parent_node.remove_entry(old_existing_node_parent_entry)
         parent_node.add_entry(existing_node_entry)
@@ -468,3 +2766,380 @@ def split(existing_node, entry, d):
             new_node.parent_node = parent_node
     assert existing_node.is_root() or existing_node.parent_node
     assert new_node.is_root() or new_node.parent_node
+
+
+#d memoized for the duration of a split. The objects are identified by id(),
+#they are all referenced by the node being split.
+class _SplitDistances(object):
+    def __init__(self, d):
+        self.d = d
+        self.distances = {}
+
+    def __call__(self, obj1, obj2):
+        key = (id(obj1), id(obj2)) if id(obj1) <= id(obj2) \
+            else (id(obj2), id(obj1))
+        distance = self.distances.get(key)
+        if distance is None:
+            distance = self.distances[key] = self.d(obj1, obj2)
+        return distance
+
+    def known(self, obj1, obj2, distance):
+        key = (id(obj1), id(obj2)) if id(obj1) <= id(obj2) \
+            else (id(obj2), id(obj1))
+        self.distances[key] = distance
+
+
+#Lowers the covering radii above node to the bound given by the distances
+#stored in the entries. Costs no distance computation.
+def _shrink_radii(node):
+    while node.parent_entry is not None and node.entries:
+        if isinstance(node, LeafNode):
+            radius = max(entry.distance_to_parent for entry in node.entries)
+        else:
+            radius = max(entry.distance_to_parent + entry.radius
+                         for entry in node.entries)
+        if radius >= node.parent_entry.radius:
+            break
+        node.parent_entry.radius = radius
+        node.parent_node._block = None
+        node = node.parent_node
+
+
+#count, zero values, min, mean, median, 90th percentile and max of values
+def _distribution(values):
+    values = sorted(float(x) for x in values)
+    if not values:
+        return collections.OrderedDict([('count', 0)])
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+
+    return collections.OrderedDict([
+        ('count', len(values)),
+        ('zero', sum(1 for x in values if x == 0)),
+        ('min', values[0]),
+        ('mean', sum(values) / len(values)),
+        ('p50', percentile(0.5)),
+        ('p90', percentile(0.9)),
+        ('max', values[-1])])
+
+
+#One pass of MTree.optimize over the leaves below node: each leaf gives its
+#object farthest from its routing object to the nearest sibling covering it
+#with room, if it is nearer to the sibling's routing object, as long as it
+#keeps max_node_size / 2 entries. Returns the
+#number of objects moved
+def _slim_down_children(node):
+    max_size = node.mtree.max_node_size
+    min_size = max(1, max_size // 2)
+    moved = 0
+    for routing_entry in list(node.entries):
+        leaf = routing_entry.subtree
+        while len(leaf) > min_size:
+            farthest = max(leaf.entries,
+                           key=attrgetter('distance_to_parent'))
+            target = None
+            for entry, distance in zip(*node.distances_to(farthest.obj)):
+                #the object must get nearer to its routing object, so that
+                #two leaves cannot pass it back and forth
+                if entry is routing_entry or distance > entry.radius or \
+                        distance >= farthest.distance_to_parent or \
+                        len(entry.subtree) >= max_size:
+                    continue
+                if target is None or distance < target[1]:
+                    target = (entry, distance)
+            if target is None:
+                break
+            leaf.remove_entry(farthest)
+            _move_entry(farthest, target[1], target[0].subtree)
+            routing_entry.radius = max(entry.distance_to_parent
+                                       for entry in leaf.entries)
+            moved += 1
+    if moved:
+        node._block = None
+    return moved
+
+
+#Recomputes the covering radii of the routing entries below node, bottom-up:
+#exactly (the largest distance to an object of the subtree) if tight, else
+#from the distances to the parents. Returns the objects of the leaves below
+#node
+def _tighten_radii(node, tight):
+    if isinstance(node, LeafNode):
+        return [entry.obj for entry in node.entries]
+    mtree = node.mtree
+    objs = []
+    for entry in node.entries:
+        subtree = entry.subtree
+        below = _tighten_radii(subtree, tight)
+        if isinstance(subtree, LeafNode):
+            entry.radius = max(e.distance_to_parent for e in subtree.entries)
+        elif not tight:
+            entry.radius = max(e.distance_to_parent + e.radius
+                               for e in subtree.entries)
+        elif mtree.vectorized:
+            entry.radius = float(mtree.d.batch(_stack(below, mtree.dtype),
+                                               entry.obj).max())
+        else:
+            entry.radius = max(mtree.d(obj, entry.obj) for obj in below)
+        objs.extend(below)
+    node._block = None
+    return objs
+
+
+#After a removal from node: while a node (other than the root) has less than
+#max_node_size / 2 entries, it is merged into its nearest sibling or, if they
+#do not fit in one node, it takes the sibling's entries nearest to it. A
+#root left with a single child is replaced by that child.
+def _fix_underflow(node):
+    mtree = node.mtree
+    min_size = max(1, mtree.max_node_size // 2)
+    while not node.is_root() and len(node) < min_size:
+        parent = node.parent_node
+        siblings = [(distance, entry) for entry, distance in
+                    zip(*parent.distances_to(node.parent_entry.obj))
+                    if entry is not node.parent_entry]
+        if not siblings:
+            #possible when max_node_size < 4, an empty node is just dropped
+            if node.entries:
+                break
+            parent.remove_entry(node.parent_entry)
+            node = parent
+            continue
+        sibling_entry = min(siblings, key=itemgetter(0))[1]
+        sibling = sibling_entry.subtree
+        if len(sibling) + len(node) <= mtree.max_node_size:
+            for entry, distance in zip(*node.distances_to(sibling_entry.obj)):
+                _move_entry(entry, distance, sibling)
+            parent.remove_entry(node.parent_entry)
+            node = parent
+        else:
+            entries, distances = sibling.distances_to(node.parent_entry.obj)
+            nearest = sorted(zip(distances, entries), key=itemgetter(0))
+            for distance, entry in nearest[:min_size - len(node)]:
+                sibling.remove_entry(entry)
+                _move_entry(entry, distance, node)
+            _shrink_radii(sibling)
+            break
+
+    root = mtree.root
+    while isinstance(root, InternalNode) and len(root) == 1:
+        root = next(iter(root.entries)).subtree
+        root.parent_node = root.parent_entry = None
+        for entry in root.entries:
+            entry.distance_to_parent = None
+        mtree.root = root
+
+
+#Adds entry, at distance of the routing object of node, to node (not the
+#root), enlarging the covering radius of node if needed
+def _move_entry(entry, distance, node):
+    entry.distance_to_parent = distance
+    node.add_entry(entry)
+    if entry.subtree is not None:
+        entry.subtree.parent_node = node
+        distance += entry.radius
+    if distance > node.parent_entry.radius:
+        node.parent_entry.radius = distance
+        node.parent_node._block = None
+
+
+_BULK_BRANCHING = 3
+_BULK_REPAIR_WINDOW = 8
+
+#Bulk-loading (Ciaccia & Patella, "Bulk loading the M-tree").
+#The objects are recursively clustered around randomly sampled seeds until
+#every cluster fits in a node, the leaves are built from the clusters and the
+#upper levels are built bottom-up by clustering the routing entries of the
+#level below in the same way, so all the leaves are at the same depth. The
+#entries of the underfilled nodes of each level are given to the nodes of
+#their nearest routing objects, so every node but the root is at least half
+#full.
+def _bulk_load(mtree, objs, rng=None):
+    rng = rng or random.Random()
+    d = mtree.d
+    max_size = mtree.max_node_size
+    min_size = max(1, max_size // 2)
+
+    if len(objs) <= max_size:
+        mtree.root = LeafNode(mtree, entries=[Entry(obj) for obj in objs])
+        return
+
+    #distances from every object to every seed, one list per seed
+    def distances(objs, seeds):
+        if mtree.vectorized:
+            block = _stack(objs, mtree.dtype)
+            return [d.batch(block, seed).tolist() for seed in seeds]
+        return [[d(obj, seed) for obj in objs] for seed in seeds]
+
+    groups = _bulk_cluster(objs, d, distances, max_size, rng)
+    groups = _bulk_repair(groups, d, distances, max_size, min_size)
+    entries = []
+    for seed, members in groups:
+        leaf = LeafNode(mtree,
+                        entries=[Entry(obj, dist) for obj, dist in members])
+        entries.append(_bulk_routing_entry(leaf, seed))
+
+    def entry_d(entry1, entry2):
+        return d(entry1.obj, entry2.obj)
+
+    def entry_distances(entries, seeds):
+        return distances([entry.obj for entry in entries],
+                         [seed.obj for seed in seeds])
+
+    while len(entries) > max_size:
+        groups = _bulk_cluster(entries, entry_d, entry_distances, max_size,
+                               rng)
+        groups = _bulk_repair(groups, entry_d, entry_distances, max_size,
+                              min_size)
+        entries = []
+        for seed, members in groups:
+            for entry, dist in members:
+                entry.distance_to_parent = dist
+            node = InternalNode(mtree,
+                                entries=[entry for entry, _ in members])
+            for entry in node.entries:
+                entry.subtree.parent_node = node
+            entries.append(_bulk_routing_entry(node, seed.obj))
+
+    root = InternalNode(mtree, entries=entries)
+    for entry in root.entries:
+        entry.distance_to_parent = None
+        entry.subtree.parent_node = root
+    mtree.root = root
+
+def _bulk_routing_entry(node, routing_object):
+    if isinstance(node, LeafNode):
+        radius = max(e.distance_to_parent for e in node.entries)
+    else:
+        radius = max(e.distance_to_parent + e.radius for e in node.entries)
+    entry = Entry(routing_object, None, radius, node)
+    node.parent_entry = entry
+    return entry
+
+#Returns a list of (seed, [(item, d(item, seed)), ...]) where every group has
+#at most max_size items and its seed is one of them. Groups coming from the
+#same cluster are next to each other in the list.
+def _bulk_cluster(items, d, distances, max_size, rng,
+                  seed=None, seed_distances=None):
+    groups = []
+    if seed is not None:
+        if len(items) <= max_size:
+            return [(seed, list(zip(items, seed_distances)))]
+        #full leaves of copies of the seed need no further clustering
+        copies = [i for i, dist in enumerate(seed_distances)
+                  if dist == 0 and items[i] is not seed]
+        full = len(copies) - len(copies) % max_size
+        if full:
+            for start in range(0, full, max_size):
+                chunk = [items[i] for i in copies[start:start+max_size]]
+                groups.append((chunk[0], [(item, 0) for item in chunk]))
+            removed = set(copies[:full])
+            kept = [i for i in range(len(items)) if i not in removed]
+            items = [items[i] for i in kept]
+            seed_distances = [seed_distances[i] for i in kept]
+            if len(items) <= max_size:
+                groups.append((seed, list(zip(items, seed_distances))))
+                return groups
+
+    #pick distinct seeds, the current seed (if any) being the first one
+    n_seeds = min(_BULK_BRANCHING, -(-len(items) // max_size))
+    seeds, rows = [], [[] for _ in items]
+    if seed is not None:
+        seeds.append(next(i for i, item in enumerate(items) if item is seed))
+        for row, dist in zip(rows, seed_distances):
+            row.append(dist)
+    candidates = list(range(len(items)))
+    rng.shuffle(candidates)
+    for candidate in candidates:
+        if len(seeds) == n_seeds:
+            break
+        if candidate in seeds:
+            continue
+        for s in seeds:
+            if d(items[candidate], items[s]) == 0:
+                break
+        else:
+            seeds.append(candidate)
+    if len(seeds) == 1:
+        #all the items are the same point
+        return groups + [(items[start],
+                          [(item, 0) for item in items[start:start+max_size]])
+                         for start in range(0, len(items), max_size)]
+
+    #every item goes to the nearest seed that still has room for it, the
+    #items with the strongest preference being placed first. The capacity
+    #bounds the depth of the recursion even on skewed data.
+    new_seeds = seeds[1:] if seed is not None else seeds
+    for column in distances(items, [items[s] for s in new_seeds]):
+        for row, dist in zip(rows, column):
+            row.append(dist)
+    capacity = -(-3 * len(items) // (2 * len(seeds)))
+    clusters = [[s] for s in seeds]
+    placed = set(seeds)
+    def preference(index):
+        first, second = sorted(rows[index])[:2]
+        return first - second
+    for index in sorted(range(len(items)), key=preference):
+        if index in placed:
+            continue
+        row = rows[index]
+        nearest = min((c for c in range(len(seeds))
+                       if len(clusters[c]) < capacity), key=row.__getitem__)
+        clusters[nearest].append(index)
+
+    for c, members in enumerate(clusters):
+        groups.extend(_bulk_cluster([items[i] for i in members],
+                                    d, distances, max_size, rng,
+                                    items[seeds[c]],
+                                    [rows[i][c] for i in members]))
+    return groups
+
+#Redistributes the items of the underfilled groups (less than min_size
+#items) to the group of their nearest seed, as in Ciaccia & Patella, then
+#splits the groups grown beyond max_size, so that every group ends with
+#min_size to max_size items. The groups coming from the same clusters being
+#next to each other, only the seeds of the _BULK_REPAIR_WINDOW groups on
+#each side in the list are candidates. distances is the one of _bulk_load.
+def _bulk_repair(groups, d, distances, max_size, min_size):
+    full = [g for g, group in enumerate(groups) if len(group[1]) >= min_size]
+    if len(full) == len(groups):
+        return groups
+    if not full:
+        full = [max(range(len(groups)), key=lambda g: len(groups[g][1]))]
+    for g, (seed, members) in enumerate(groups):
+        if len(members) >= min_size or g == full[0]:
+            continue
+        targets = [t for t in full if abs(t - g) <= _BULK_REPAIR_WINDOW] \
+            or full
+        items = [item for item, _ in members]
+        columns = distances(items, [groups[t][0] for t in targets])
+        for i, item in enumerate(items):
+            nearest = min(range(len(targets)), key=lambda t: columns[t][i])
+            groups[targets[nearest]][1].append((item, columns[nearest][i]))
+    repaired = []
+    for g in full:
+        repaired.extend(_bulk_split(groups[g][0], groups[g][1], d, max_size))
+    return repaired
+
+#Splits a group of more than max_size items into the fewest groups of at
+#most max_size items, of sizes differing by at most one (so at least
+#max_size // 2): each new group takes the items nearest to its seed, the
+#next seed being the remaining item farthest from the previous one.
+def _bulk_split(seed, members, d, max_size):
+    parts = -(-len(members) // max_size)
+    if parts == 1:
+        return [(seed, members)]
+    def by_distance(members, seed):
+        return sorted(members, key=lambda member: (member[0] is not seed,
+                                                   member[1]))
+    groups, rest = [], by_distance(members, seed)
+    for part in range(parts):
+        size = len(members) // parts + (part < len(members) % parts)
+        groups.append((seed, rest[:size]))
+        rest = rest[size:]
+        if rest:
+            seed = rest[-1][0]
+            rest = by_distance([(item, d(item, seed)) for item, _ in rest],
+                               seed)
+    return groups
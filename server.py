@@ -0,0 +1,332 @@
+#Long-lived query service over the Pandas.csv index.
+#
+#The index (a vectorized L1 MTree of the 11 attributes, identified by the
+#Pacient_ID) is loaded once from its snapshot, or built from the CSV and
+#saved when the snapshot is missing or older than the CSV. The server speaks
+#line-delimited JSON over a Unix-domain socket or a localhost TCP port:
+#
+#   {"id": 1, "op": "knn", "vector": [0, 0.5, ...], "k": 5}
+#   {"id": 2, "op": "range", "vector": [0, 0.5, ...], "radius": 2.5}
+#   {"id": 3, "op": "ping"}
+#
+#and answers each request with one line carrying the same id:
+#
+#   {"id": 1, "results": [{"id": "44477f75e8169d2", "distance": 0.0}, ...],
+#    "seconds": 0.0004}
+#   {"id": 2, "error": "..."}
+#
+#Requests are pipelined: a client may send many lines without waiting, the
+#searches run in a thread or process pool and the responses are written as
+#they complete, not necessarily in order.
+#
+#   python server.py serve --socket mtree.sock --workers 4 --processes
+#   python server.py query --socket mtree.sock --k 5 0 0.5 0.1 ...
+#   python server.py load --socket mtree.sock --requests 5000 --concurrency 64
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from itertools import islice
+
+import numpy as np
+
+import mtree
+
+DIMENSIONS = 11
+#requests of a connection being searched at the same time, reading from a
+#client that sends faster stops beyond this
+MAX_IN_FLIGHT = 256
+
+_tree = None
+
+
+def load_index(csv='Pandas.csv', path='Pandas.l1.mtree', max_node_size=32):
+    if os.path.exists(path) and \
+            os.path.getmtime(path) >= os.path.getmtime(csv):
+        return mtree.MTree.load(path, mtree.L1())
+    import main
+    ids, features = main.load_dataset(csv)
+    #most rows only have the label and the age quantile: equal vectors share
+    #one entry
+    tree = mtree.MTree(mtree.L1(), max_node_size, collapse_duplicates=True)
+    tree.add_all(features, ids=[str(i) for i in ids])
+    tree.save(path)
+    return tree
+
+
+def _init_worker(path):
+    global _tree
+    _tree = mtree.MTree.load(path, mtree.L1())
+
+
+#runs one request on the tree of this process (thread pool) or of the
+#worker (process pool)
+def _search(request):
+    start = time.perf_counter()
+    vector = np.asarray(request['vector'], 'float64')
+    if vector.shape != (DIMENSIONS,):
+        raise ValueError('vector must have %d values' % DIMENSIONS)
+    if request['op'] == 'knn':
+        found = islice(_tree.nearest(vector), int(request.get('k', 1)))
+    else:
+        found = _tree.search_in_radius_iter(vector, float(request['radius']),
+                                            sort=True,
+                                            limit=request.get('limit'))
+    results = [{'id': obj.id, 'distance': distance}
+               for obj, distance in found]
+    return {'id': request.get('id'), 'results': results,
+            'seconds': time.perf_counter() - start}
+
+
+class Server(object):
+    def __init__(self, executor):
+        self.executor = executor
+        self.requests = 0
+        self.started = time.time()
+
+    async def handle(self, reader, writer):
+        in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                await in_flight.acquire()
+                task = asyncio.ensure_future(self.answer(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                task.add_done_callback(lambda _: in_flight.release())
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def answer(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            op = request.get('op')
+            if op == 'ping':
+                response = {'id': request_id, 'pong': True}
+            elif op == 'info':
+                response = {'id': request_id, 'objects': len(_tree),
+                            'requests': self.requests,
+                            'uptime': time.time() - self.started}
+            elif op in ('knn', 'range'):
+                response = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, _search, request)
+            else:
+                raise ValueError('unknown op %r' % (op,))
+        except Exception as error:
+            response = {'id': request_id, 'error': '%s: %s' % (
+                type(error).__name__, error)}
+        self.requests += 1
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        await writer.drain()
+
+
+async def serve(args):
+    global _tree
+    start = time.time()
+    _tree = load_index(args.csv, args.index)
+    print('index of %d objects ready in %.3f s' % (len(_tree),
+                                                   time.time() - start))
+    if args.processes:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            args.workers, initializer=_init_worker, initargs=(args.index,))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(args.workers)
+    server = Server(executor)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        listener = await asyncio.start_unix_server(server.handle,
+                                                   args.socket)
+        print('listening on %s' % args.socket)
+    else:
+        listener = await asyncio.start_server(server.handle, args.host,
+                                              args.port)
+        print('listening on %s:%d' % (args.host, args.port))
+    sys.stdout.flush()
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        executor.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+#Pipelining client: request() sends a line and returns a future resolved when
+#the response with the same id arrives
+class Client(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count()
+        self.waiting = {}
+        self.receiver = asyncio.ensure_future(self._receive())
+
+    @classmethod
+    async def connect(cls, socket=None, host='127.0.0.1', port=8765):
+        if socket:
+            reader, writer = await asyncio.open_unix_connection(socket)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, op, **parameters):
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = future
+        parameters.update(id=request_id, op=op)
+        self.writer.write(json.dumps(parameters).encode('utf-8') + b'\n')
+        await self.writer.drain()
+        response = await future
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def knn(self, vector, k=1):
+        return self.request('knn', vector=list(vector), k=k)
+
+    def range(self, vector, radius, limit=None):
+        return self.request('range', vector=list(vector), radius=radius,
+                            limit=limit)
+
+    async def _receive(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self.waiting.pop(response.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('connection closed'))
+
+    async def close(self):
+        self.writer.close()
+        await self.receiver
+
+
+async def query(args):
+    client = await Client.connect(args.socket, args.host, args.port)
+    try:
+        if args.radius is not None:
+            response = await client.range(args.vector, args.radius)
+        else:
+            response = await client.knn(args.vector, args.k)
+    finally:
+        await client.close()
+    for result in response['results']:
+        print('%s\t%g' % (result['id'], result['distance']))
+    print('%d objects in %.6f s' % (len(response['results']),
+                                    response['seconds']))
+
+
+#Sends args.requests queries (rows of the CSV plus noise, k-NN or range at
+#random) keeping args.concurrency of them in flight, and reports the
+#throughput and the latencies seen by the client
+async def load(args):
+    import main
+    _, features = main.load_dataset(args.csv)
+    rng = random.Random(args.seed)
+    client = await Client.connect(args.socket, args.host, args.port)
+    latencies = []
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        row = features[rng.randrange(len(features))]
+        vector = [float(x) + rng.gauss(0, 0.05) for x in row]
+        start = time.perf_counter()
+        try:
+            if rng.random() < args.knn_ratio:
+                await client.knn(vector, args.k)
+            else:
+                await client.range(vector, args.radius)
+        except RuntimeError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def limited():
+        async with slots:
+            await one()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[limited() for _ in range(args.requests)])
+    elapsed = time.perf_counter() - start
+    await client.close()
+    latencies = np.array(latencies)
+    report = {'requests': args.requests, 'errors': errors,
+              'concurrency': args.concurrency, 'seconds': elapsed,
+              'requests_per_second': args.requests / elapsed,
+              'latency_p50': float(np.percentile(latencies, 50)),
+              'latency_p99': float(np.percentile(latencies, 99))}
+    print(json.dumps(report, indent=2))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='MTree query service.')
+    parser.add_argument('--socket', default=None,
+                        help='Unix-domain socket (default: TCP on --host '
+                             'and --port)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve_parser = commands.add_parser('serve', help='run the server')
+    serve_parser.add_argument('--csv', default='Pandas.csv')
+    serve_parser.add_argument('--index', default='Pandas.l1.mtree',
+                              help='snapshot of the index')
+    serve_parser.add_argument('--workers', type=int,
+                              default=os.cpu_count() or 1)
+    serve_parser.add_argument('--processes', action='store_true',
+                              help='search in worker processes (each loads '
+                                   'the snapshot) instead of threads')
+
+    query_parser = commands.add_parser('query', help='send one query')
+    query_parser.add_argument('--k', type=int, default=1)
+    query_parser.add_argument('--radius', type=float, default=None,
+                              help='range query instead of k-NN')
+    query_parser.add_argument('vector', type=float, nargs=DIMENSIONS)
+
+    load_parser = commands.add_parser('load', help='load generator')
+    load_parser.add_argument('--csv', default='Pandas.csv')
+    load_parser.add_argument('--requests', type=int, default=1000)
+    load_parser.add_argument('--concurrency', type=int, default=32)
+    load_parser.add_argument('--knn-ratio', type=float, default=0.5)
+    load_parser.add_argument('--k', type=int, default=5)
+    load_parser.add_argument('--radius', type=float, default=1.0)
+    load_parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    command = {'serve': serve, 'query': query, 'load': load}[args.command]
+    try:
+        asyncio.run(command(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
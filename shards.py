@@ -0,0 +1,393 @@
+#MTree sharded over worker processes.
+#
+#The objects are split by their distance to pivots: the pivots are drawn
+#from a sample of the objects, spread out like the k-means++ seeds, and each
+#object goes to the shard of its nearest pivot. The covering radius of a
+#shard is the distance from its pivot to its farthest object, so a shard
+#holds no object nearer to a query q than d(q, pivot) - radius, nor, its
+#objects being nearer to its pivot than to the others, than half the
+#difference between d(q, pivot) and the distance from q to its nearest
+#pivot.
+#
+#Each shard is an MTree built, and then queried, in its own worker process:
+#the shards are built and searched in parallel and each object is kept by
+#its shard only. The coordinator keeps the routing data (the pivots, their
+#covering radii and the shard sizes) and the shards send back the objects
+#found with their distances. The workers are started with the index, before
+#the objects are given, so they do not inherit them.
+#A query is scattered to the shards whose ball it can reach and the results
+#are gathered and merged. A k-NN query first asks the shard of the pivot
+#nearest to the query, then the other shards that can hold an object nearer
+#than the k-th one found, with that distance as the bound of their search.
+#
+#   index = ShardedMTree(mtree.L1(), 4, 32)
+#   index.add_all(features, ids=ids)
+#   index.search(query, k=10)
+#   index.close()
+import heapq
+import itertools
+from itertools import islice
+import multiprocessing
+from operator import itemgetter
+import random
+import time
+
+import numpy as np
+
+import mtree
+
+
+class ShardedMTree(object):
+    #d, max_node_size, promote, partition, seed and collapse_duplicates are
+    #those of the MTree of each shard (seed + shard number for the shard, so
+    #that a seeded index is rebuilt the same). With processes False the
+    #shards are kept in this process, which is only useful to test the
+    #partitioning. Otherwise the workers are forked when fork is available,
+    #else d, promote and partition must be picklable. The objects go to the
+    #workers and back through pipes and must be picklable; in vectorized
+    #mode the results are Rows of a one-row matrix, with the id of the
+    #object (its row number when add_all is given no ids)
+    def __init__(self,
+                 d,
+                 shards,
+                 max_node_size,
+                 promote=mtree.M_LB_DIST_confirmed,
+                 partition=mtree.generalized_hyperplane,
+                 seed=None,
+                 collapse_duplicates=False,
+                 processes=True,
+                 sample_size=100):
+        if not callable(d):
+            raise TypeError('d is not a function')
+        if shards < 1:
+            raise ValueError('shards must be >= 1 but is %d' % shards)
+        self.d = d
+        self.vectorized = callable(getattr(d, 'batch', None))
+        self.dtype = getattr(d, 'dtype', None)
+        self.shard_count = shards
+        self.max_node_size = max_node_size
+        self.promote = promote
+        self.partition = partition
+        self.seed = seed
+        self.collapse_duplicates = collapse_duplicates
+        self.processes = processes
+        #objects sampled per shard to choose the pivots
+        self.sample_size = sample_size
+        self.rng = random.Random(seed)
+        self.pivots = []
+        self.radii = []
+        self.sizes = []
+        #the pivots as one matrix in vectorized mode
+        self._pivot_block = None
+
+        if processes and 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        self.shards = []
+        for i in range(shards):
+            tree = mtree.MTree(d, max_node_size, promote, partition,
+                               None if seed is None else seed + i,
+                               collapse_duplicates)
+            self.shards.append(_ProcessShard(context, tree) if processes
+                               else _LocalShard(tree))
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    #stops the worker processes, the index can no longer be queried
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+
+    #Splits the objects into the shards and builds them. Only possible on an
+    #empty index: more objects are then added with add. Returns a
+    #BuildStats counting the distance calls of the partitioning and of the
+    #builds of all the shards
+    def add_all(self, iterable, ids=None):
+        if self.pivots:
+            raise ValueError('the shards are already built, use add')
+        if not self.shards:
+            raise ValueError('the index is closed')
+        if self.vectorized and getattr(iterable, 'ndim', None) == 2:
+            data = np.ascontiguousarray(iterable, self.dtype)
+            iterable = [mtree.Row(data, i, i if ids is None else ids[i])
+                        for i in range(len(data))]
+        objs = list(iterable)
+        if not objs:
+            raise ValueError('no objects to shard')
+        start = time.perf_counter()
+        counter = mtree._CountingDistance(self.d)
+        shard_count = min(self.shard_count, len(objs))
+        self.pivots = _choose_pivots(objs, counter, shard_count,
+                                     self.sample_size * shard_count,
+                                     self.rng, self.vectorized, self.dtype)
+        if self.vectorized:
+            #the pivots must not keep the matrix of the objects alive
+            self._pivot_block = mtree._stack(self.pivots, self.dtype)
+            self.pivots = [mtree.Row(self._pivot_block, i,
+                                     getattr(pivot, 'id', None))
+                           for i, pivot in enumerate(self.pivots)]
+        nearest, distances = self._assign(objs, counter)
+        members = [[] for _ in self.pivots]
+        self.radii = [0] * len(self.pivots)
+        for number, (shard, distance) in enumerate(zip(nearest, distances)):
+            members[shard].append(number)
+            if distance > self.radii[shard]:
+                self.radii[shard] = distance
+        self.sizes = [len(numbers) for numbers in members]
+
+        #less distinct objects than shards: the extra workers are stopped
+        for shard in self.shards[len(self.pivots):]:
+            shard.close()
+        del self.shards[len(self.pivots):]
+        for shard, numbers in zip(self.shards, members):
+            shard.send(('build', self._shard_objects(objs, numbers)))
+        #the shards are built at the same time, wait for all of them
+        calls = counter.calls
+        for shard in self.shards:
+            calls += shard.receive().distance_calls
+        return mtree.BuildStats(len(objs), calls,
+                                time.perf_counter() - start)
+
+    #inserts obj in the shard of its nearest pivot, enlarging its radius
+    def add(self, obj):
+        if not self.pivots:
+            self.add_all([obj])
+            return
+        nearest, distances = self._assign([obj], self.d)
+        shard, distance = nearest[0], distances[0]
+        if distance > self.radii[shard]:
+            self.radii[shard] = distance
+        self.sizes[shard] += 1
+        self.shards[shard].send(('add', _result_object(obj)))
+        self.shards[shard].receive()
+
+    #list of the k nearest objects of query_obj, nearest first
+    def search(self, query_obj, k=1):
+        return [obj for obj, _ in self.search_with_distances(query_obj, k)]
+
+    #[(obj, d(obj, query_obj))] of the k nearest objects, nearest first
+    def search_with_distances(self, query_obj, k=1):
+        if not self.pivots or not self.shards or k < 1:
+            return []
+        pivot_distances = self._pivot_distances(query_obj)
+        query = mtree._plain_query(query_obj)
+        first = min(range(len(self.shards)), key=pivot_distances.__getitem__)
+        self.shards[first].send(('knn', query, k, float('inf')))
+        found = self.shards[first].receive()
+        radius = found[-1][1] if len(found) == k else float('inf')
+        others = [i for i in self._reachable(pivot_distances, radius)
+                  if i != first]
+        for i in others:
+            self.shards[i].send(('knn', query, k, radius))
+        for i in others:
+            found.extend(self.shards[i].receive())
+        return heapq.nsmallest(k, found, key=itemgetter(1))
+
+    #list of the objects within distance of query_obj, nearest first
+    def search_in_radius(self, query_obj, distance):
+        return [obj for obj, _ in
+                self.search_in_radius_iter(query_obj, distance, sort=True)]
+
+    #iterator of (obj, d(obj, query_obj)) for the objects within distance
+    #of query_obj, in increasing distance order if sort. The reachable
+    #shards are searched at the same time, their results are merged here
+    def search_in_radius_iter(self, query_obj, distance, sort=False):
+        if not self.pivots or not self.shards:
+            return iter(())
+        reachable = self._reachable(self._pivot_distances(query_obj),
+                                    distance)
+        query = mtree._plain_query(query_obj)
+        for i in reachable:
+            self.shards[i].send(('range', query, distance, sort))
+        found = [self.shards[i].receive() for i in reachable]
+        return heapq.merge(*found, key=itemgetter(1)) if sort \
+            else itertools.chain.from_iterable(found)
+
+    #the number of objects and the covering radius of each shard
+    def describe(self):
+        return [{'shard': i, 'objects': size, 'radius': float(radius)}
+                for i, (size, radius) in enumerate(zip(self.sizes,
+                                                       self.radii))]
+
+    #the shard of the nearest pivot of each object and its distance
+    def _assign(self, objs, d):
+        if self.vectorized:
+            block = mtree._stack(objs, self.dtype)
+            distances = np.array([d.batch(block, pivot)
+                                  for pivot in self.pivots])
+            nearest = distances.argmin(axis=0)
+            return (nearest.tolist(),
+                    distances[nearest, np.arange(len(objs))].tolist())
+        nearest, distances = [], []
+        for obj in objs:
+            shard_distances = [d(obj, pivot) for pivot in self.pivots]
+            shard = min(range(len(shard_distances)),
+                        key=shard_distances.__getitem__)
+            nearest.append(shard)
+            distances.append(shard_distances[shard])
+        return nearest, distances
+
+    def _pivot_distances(self, query_obj):
+        if self.vectorized:
+            return self.d.batch(self._pivot_block,
+                                np.asarray(query_obj)).tolist()
+        return [self.d(pivot, query_obj) for pivot in self.pivots]
+
+    #the shards that can hold an object within radius of the query: an
+    #object of shard i is at least at d(q, pivot i) - radius i of the query
+    #q and, being nearer to pivot i than to any other pivot, at least at
+    #(d(q, pivot i) - d(q, pivot j)) / 2 (the generalized hyperplane bound)
+    def _reachable(self, pivot_distances, radius):
+        radius += mtree._ROUNDING_SLACK
+        nearest = min(pivot_distances)
+        return [i for i, (distance, shard_radius) in
+                enumerate(zip(pivot_distances, self.radii))
+                if distance - shard_radius <= radius and
+                (distance - nearest) / 2 <= radius]
+
+    #the objects sent to a shard: the vectors of Rows as one matrix with
+    #their ids, a Row pickles the whole matrix it is a row of
+    def _shard_objects(self, objs, numbers):
+        objs = [objs[number] for number in numbers]
+        if self.vectorized and objs and \
+                all(type(obj) is mtree.Row for obj in objs):
+            return mtree._stack(objs, self.dtype), [obj.id for obj in objs]
+        return objs
+
+
+#shards pivots among a sample of sample_size objects: the first one at
+#random, each next one with a probability proportional to the square of its
+#distance to the nearest pivot already chosen (the k-means++ seeding), which
+#spreads them out without favouring the outliers as much as taking the
+#farthest object
+def _choose_pivots(objs, d, shards, sample_size, rng, vectorized, dtype):
+    sample = objs if len(objs) <= sample_size else rng.sample(objs,
+                                                              sample_size)
+    if vectorized:
+        block = mtree._stack(sample, dtype)
+
+        def distances(pivot):
+            return d.batch(block, pivot).tolist()
+    else:
+        def distances(pivot):
+            return [d(obj, pivot) for obj in sample]
+
+    pivots = [sample[rng.randrange(len(sample))]]
+    nearest = distances(pivots[0])
+    while len(pivots) < shards:
+        weights = [x * x for x in nearest]
+        if not any(weights):
+            #less distinct objects than shards
+            break
+        pivot = rng.choices(sample, weights)[0]
+        pivots.append(pivot)
+        nearest = [min(x, y) for x, y in zip(nearest, distances(pivot))]
+    return pivots
+
+
+#the objects of a shard as given to the MTree: Rows of the matrix sent by
+#ShardedMTree._shard_objects
+def _tree_objects(objs):
+    if isinstance(objs, tuple):
+        data, ids = objs
+        return [mtree.Row(data, i, row_id) for i, row_id in enumerate(ids)]
+    return objs
+
+
+#an object as sent to and by a worker: a Row as a Row of its own one-row
+#matrix (a view, which pickles the vector only)
+def _result_object(obj):
+    if type(obj) is mtree.Row:
+        return mtree.Row(obj.data[obj.index:obj.index + 1], 0, obj.id)
+    return obj
+
+
+#answers a request of ShardedMTree: the BuildStats of the shard for
+#'build', (object, distance) pairs for the queries
+def _handle(tree, request):
+    op = request[0]
+    if op == 'build':
+        return tree.add_all(_tree_objects(request[1]))
+    if op == 'knn':
+        _, query, k, max_distance = request
+        found = islice(tree.nearest(query, max_distance), k)
+    elif op == 'range':
+        _, query, distance, sort = request
+        found = tree.search_in_radius_iter(query, distance, sort)
+    elif op == 'add':
+        tree.add(request[1])
+        return []
+    else:
+        raise ValueError('unknown request %r' % (op,))
+    return [(_result_object(obj), distance) for obj, distance in found]
+
+
+#a shard kept in this process: send computes the answer received next
+class _LocalShard(object):
+    def __init__(self, tree):
+        self.tree = tree
+        self.answer = None
+
+    def send(self, request):
+        self.answer = _handle(self.tree, request)
+
+    def receive(self):
+        return self.answer
+
+    def close(self):
+        pass
+
+
+#a shard in a worker process, requests and answers go through a pipe
+class _ProcessShard(object):
+    def __init__(self, context, tree):
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=_serve_shard,
+                                       args=(worker_connection, tree))
+        self.process.daemon = True
+        self.process.start()
+        worker_connection.close()
+
+    def send(self, request):
+        self.connection.send(request)
+
+    def receive(self):
+        answer = self.connection.recv()
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def close(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join()
+        self.connection.close()
+
+
+#main loop of a worker: answers the requests, the first one building its
+#shard, until it gets None
+def _serve_shard(connection, tree):
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            answer = _handle(tree, request)
+        except Exception as error:
+            answer = error
+        connection.send(answer)
+    connection.close()